@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Benchmark the cold import time of the entrance package
+#
+# Copyright (c) 2018 Ensoft Ltd
+
+import argparse, os, re, statistics, subprocess, sys
+
+_line = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def run_once(statement):
+    """
+    Import in a fresh interpreter, returning the total time in microseconds
+    and a dict of cumulative time per module
+    """
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        env=env,
+        check=True,
+        universal_newlines=True,
+    )
+    total = 0
+    modules = {}
+    for line in proc.stderr.splitlines():
+        m = _line.match(line)
+        if m:
+            cumulative, depth, module = int(m.group(2)), len(m.group(3)), m.group(4)
+            modules[module] = cumulative
+            if depth == 1:
+                total += cumulative
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument("-t", "--top", type=int, default=15)
+    parser.add_argument(
+        "-s", "--statement", default="import entrance", help="code to time"
+    )
+    opts = parser.parse_args()
+
+    # One untimed run to make sure .pyc files are written
+    run_once(opts.statement)
+    totals = []
+    per_module = {}
+    for _ in range(opts.runs):
+        total, modules = run_once(opts.statement)
+        totals.append(total)
+        for module, usecs in modules.items():
+            per_module.setdefault(module, []).append(usecs)
+
+    print(
+        "{!r}: median {:.1f}ms, min {:.1f}ms over {} runs".format(
+            opts.statement,
+            statistics.median(totals) / 1000,
+            min(totals) / 1000,
+            opts.runs,
+        )
+    )
+    print("Slowest modules (median cumulative ms):")
+    medians = sorted(
+        ((statistics.median(v), k) for k, v in per_module.items()), reverse=True
+    )
+    for usecs, module in medians[: opts.top]:
+        print("  {:8.1f}  {}".format(usecs / 1000, module))
+
+    loaded = run_once(opts.statement)[1]
+    for heavy in ("paramiko", "ncclient", "lxml"):
+        print("{} imported: {}".format(heavy, heavy in loaded))
+
+
+if __name__ == "__main__":
+    main()
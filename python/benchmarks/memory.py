@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Benchmark the memory used by each idle session and connection
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""
+Measure (with tracemalloc) the Python heap used by each idle websocket
+session, with its configured features, and by each router connection (not
+counting the stack of its worker thread, which only exists once connected).
+"""
+
+import argparse, asyncio, gc, tracemalloc
+
+from entrance.connection import connection_factory_by_name
+from entrance.ws_handler import WebsocketHandler
+
+
+class IdleWebsocket:
+    """
+    Stands in for a websocket that never has anything to say
+    """
+
+    async def recv(self):
+        await asyncio.Event().wait()
+
+    async def send(self, data):
+        pass
+
+
+def per_object(make, count):
+    """
+    Average heap bytes per object, for count objects from make(n)
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(n) for n in range(count)]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+async def run(opts):
+    feature_config = {name: {} for name in opts.features}
+    session = per_object(
+        lambda n: WebsocketHandler(IdleWebsocket(), feature_config), opts.sessions
+    )
+    print(
+        "Idle session ({}): {:.0f} bytes".format(", ".join(opts.features), session)
+    )
+
+    factory_cls = connection_factory_by_name[opts.connection_type]
+    factory = factory_cls(host="127.0.0.1", username="sim", password="sim")
+    for kind in ("cli", "netconf"):
+        con_cls = getattr(factory, kind + "_connection_cls")
+        per_con = per_object(
+            lambda n: con_cls(factory, "{}{}".format(kind, n)), opts.connections
+        )
+        print("{} connection: {:.0f} bytes".format(con_cls.__name__, per_con))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--sessions", type=int, default=10000)
+    parser.add_argument("-c", "--connections", type=int, default=1000)
+    parser.add_argument(
+        "-f", "--features", nargs="*", default=["core"], help="configured features"
+    )
+    parser.add_argument("-t", "--connection-type", default="ssh")
+    opts = parser.parse_args()
+    asyncio.run(run(opts))
+
+
+if __name__ == "__main__":
+    main()
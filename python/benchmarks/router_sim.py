@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# Benchmark the router connections at scale, against simulated devices
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""
+Start the device simulator (entrance.simulator) in a separate process, then
+drive the real SSHConnectionFactory connections against hundreds of
+simulated devices at once, the same way the router features do. Reports the
+time to connect, latency percentiles and overall throughput.
+
+The sessions can also be recorded into a transcript (--record), and later
+replayed instead of using the simulator (--replay), to benchmark everything
+above the connections without any SSH at all.
+
+With --processes, the connections run in a pool of worker processes (as with
+the "connection_processes" start config option).
+"""
+
+import argparse, asyncio, os, statistics, subprocess, sys, time
+
+# Use the entrance package from this checkout, even if it isn't installed (and
+# make sure the simulator process does too)
+_python_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _python_dir)
+
+from entrance.connection import ConState, connection_factory_by_name
+from entrance.connection.replay import (
+    RecordingConnectionFactory,
+    ReplayConnectionFactory,
+)
+from entrance.connection.sharded import ShardPool
+
+
+def start_simulator(opts):
+    """
+    Start the simulator, returning the process and the port it listens on
+    """
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "entrance.simulator",
+            "--latency",
+            str(opts.latency),
+            "--jitter",
+            str(opts.jitter),
+            "--output-bytes",
+            str(opts.output_bytes),
+            "--syslog-rate",
+            str(opts.syslog_rate),
+            "--netconf-bytes",
+            str(opts.netconf_bytes),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        env=dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(
+                filter(None, [_python_dir, os.environ.get("PYTHONPATH")])
+            ),
+        ),
+    )
+    line = proc.stdout.readline()
+    return proc, int(line.rsplit(":", 1)[1])
+
+
+async def wait_connected(con):
+    """
+    Wait for a new connection to finish connecting (and finalizing)
+    """
+    done = asyncio.get_running_loop().create_future()
+
+    async def listener(con):
+        if con.state == ConState.CONNECTED or con.state.is_failure():
+            if not done.done():
+                done.set_result(con.state)
+
+    con.add_state_listener(listener)
+    state = await done
+    con.remove_state_listener(listener)
+    if state != ConState.CONNECTED:
+        raise RuntimeError(
+            "{} failed: {}".format(con.name, getattr(state, "failure_reason", ""))
+        )
+
+
+async def connect(factory, mode):
+    """
+    Get a connection of the right kind, finalized the way the corresponding
+    feature does it
+    """
+    if mode == "netconf":
+        con = await factory.get_netconf_connection("netconf")
+    else:
+        commands = ["run stty rows 0"]
+        if mode == "syslog":
+            commands = ["undebug all all-tty", "terminal monitor"]
+
+        async def finalizer():
+            for command in commands:
+                await con.send(command + "\n", override=True)
+                await con.expect_prompt(override=True)
+
+        con = await factory.get_cli_connection(mode, finalizer)
+    await wait_connected(con)
+    return con
+
+
+def make_factory(n, port, opts):
+    """
+    Connection factory for the nth device
+    """
+    if opts.replay:
+        return ReplayConnectionFactory(
+            transcript=opts.replay, time_scale=opts.time_scale
+        )
+    params = {
+        "host": "127.0.0.1",
+        "ssh_port": port,
+        "netconf_port": port,
+        "username": "sim{:04}".format(n),
+        "password": "sim",
+    }
+    if opts.record:
+        return RecordingConnectionFactory(transcript=opts.record, **params)
+    return connection_factory_by_name["ssh"](**params)
+
+
+async def run_device(n, port, opts, results):
+    factory = make_factory(n, port, opts)
+    start = time.perf_counter()
+    con = await connect(factory, opts.mode)
+    results["connect"].append(time.perf_counter() - start)
+    await results["all_connected"].wait()
+
+    if opts.mode == "syslog":
+        await con.settimeout(1)
+        deadline = time.monotonic() + opts.duration
+        while time.monotonic() < deadline:
+            data = (await con.recv()).decode()
+            results["syslogs"] += data.count("\n")
+    else:
+        for _ in range(opts.requests):
+            start = time.perf_counter()
+            if opts.mode == "netconf":
+                reply = await con.get_config("")
+                results["bytes"] += len(reply.xml)
+            else:
+                await con.send(opts.command + "\n")
+                output = await con.expect_prompt()
+                results["bytes"] += len(output)
+            results["latency"].append(time.perf_counter() - start)
+    return con
+
+
+def percentiles(values):
+    values = sorted(values)
+    return "p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+        *(
+            values[min(int(q * len(values)), len(values) - 1)] * 1000
+            for q in (0.5, 0.9, 0.99, 1.0)
+        )
+    )
+
+
+async def run(opts, port):
+    # Results from all devices, with an event to start their requests all
+    # together, once every device is connected
+    results = {
+        "connect": [],
+        "latency": [],
+        "bytes": 0,
+        "syslogs": 0,
+        "all_connected": asyncio.Event(),
+    }
+    if opts.processes:
+        await ShardPool(opts.processes).start()
+    start = time.perf_counter()
+    tasks = [
+        asyncio.ensure_future(run_device(n, port, opts, results))
+        for n in range(opts.devices)
+    ]
+    while len(results["connect"]) < opts.devices:
+        await asyncio.wait(tasks, timeout=0.1, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [task for task in tasks if task.done() and task.exception()]
+        if failed:
+            raise failed[0].exception()
+    connected = time.perf_counter()
+    results["all_connected"].set()
+    await asyncio.gather(*tasks)
+    finished = time.perf_counter()
+
+    print(
+        "Connected {} {} sessions in {:.2f}s ({})".format(
+            opts.devices, opts.mode, connected - start, percentiles(results["connect"])
+        )
+    )
+    elapsed = finished - connected
+    if opts.mode == "syslog":
+        print(
+            "Received {} syslog lines in {:.2f}s ({:.0f}/s)".format(
+                results["syslogs"], elapsed, results["syslogs"] / elapsed
+            )
+        )
+    else:
+        count = len(results["latency"])
+        print(
+            "{} requests in {:.2f}s: {:.0f}/s, {:.1f}MB/s".format(
+                count, elapsed, count / elapsed, results["bytes"] / elapsed / 1e6
+            )
+        )
+        print(
+            "Latency: mean {:.1f}ms, {}".format(
+                statistics.mean(results["latency"]) * 1000,
+                percentiles(results["latency"]),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-d", "--devices", type=int, default=200)
+    parser.add_argument(
+        "-m", "--mode", choices=("cli_exec", "netconf", "syslog"), default="cli_exec"
+    )
+    parser.add_argument(
+        "-r", "--requests", type=int, default=20, help="requests per device"
+    )
+    parser.add_argument("-c", "--command", default="show interfaces brief")
+    parser.add_argument(
+        "-t", "--duration", type=float, default=10, help="seconds of syslogs"
+    )
+    parser.add_argument(
+        "-l", "--latency", type=float, default=0.0, help="simulated device latency"
+    )
+    parser.add_argument("-j", "--jitter", type=float, default=0.0)
+    parser.add_argument("-o", "--output-bytes", type=int, default=2000)
+    parser.add_argument("-s", "--syslog-rate", type=float, default=10)
+    parser.add_argument("-n", "--netconf-bytes", type=int, default=5000)
+    parser.add_argument("--record", metavar="FILE", help="record a transcript")
+    parser.add_argument(
+        "--replay", metavar="FILE", help="replay a transcript, without simulator"
+    )
+    parser.add_argument(
+        "--time-scale", type=float, default=0, help="for replayed timings"
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=0, help="connection worker processes"
+    )
+    opts = parser.parse_args()
+
+    if opts.replay:
+        asyncio.new_event_loop().run_until_complete(run(opts, None))
+        return
+    proc, port = start_simulator(opts)
+    try:
+        # Not asyncio.run, which would cancel the connections' tasks at the
+        # end: they're left to die with the process
+        asyncio.new_event_loop().run_until_complete(run(opts, port))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
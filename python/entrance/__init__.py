@@ -1,11 +1,24 @@
 import runpy
 
+from entrance import connection, feature
 from entrance.connection import *
 from entrance.exceptions import *
 from entrance.feature import *
 from entrance.ws_handler import *
 
 
+def __getattr__(name):
+    """
+    Pass on lookups of the lazily-imported feature and connection classes
+    """
+    for module in (feature, connection):
+        try:
+            return getattr(module, name)
+        except AttributeError:
+            pass
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+
 def main():
     """
     Run the entrance module (via __main__.py) in the current Python process.
@@ -2,7 +2,7 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import argparse, functools, logging, logging.config, sys
+import argparse, functools, logging, multiprocessing, os, signal, sys
 import sanic, sanic.worker.loader, yaml
 
 from . import server
@@ -48,12 +48,20 @@ def main(*args, task=None):
     if opts.debug:
         logging_config["handlers"]["console"]["level"] = "DEBUG"
 
-    # Go
-    logging.config.dictConfig(logging_config)
-    logging.setLogRecordFactory(logger.FormattedLogRecord)
+    # Go. The worker processes forward their log records to this one, which
+    # is the only one to write them out (so eg log file rotation is safe).
+    logger.configure(logging_config)
+    log_queue = logger.listen_for_workers()
 
     loader = sanic.worker.loader.AppLoader(
-        factory=functools.partial(server.create_app, main_config, location)
+        factory=functools.partial(
+            server.create_app,
+            main_config,
+            location,
+            opts.config,
+            logging_config=logging_config,
+            log_queue=log_queue,
+        )
     )
     app = loader.load()
 
@@ -67,6 +75,11 @@ def main(*args, task=None):
         ", ".join(["{}={}".format(k, v) for k, v in start_cfg.items()]),
     )
 
+    # Pass on config reload (SIGHUP) and warm hand-off (SIGUSR2) signals to
+    # the worker processes
+    for signum in _forwarded_signals:
+        signal.signal(signum, _forward_signal)
+
     # Enter event loop
     app.prepare(host=start_cfg["host"], port=int(start_cfg["port"]), dev=False, motd=False)
     sanic.Sanic.serve(primary=app, app_loader=loader)
@@ -74,12 +87,31 @@ def main(*args, task=None):
     log.info("Closing down gracefully")
 
 
+_forwarded_signals = [
+    getattr(signal, name) for name in ("SIGHUP", "SIGUSR2") if hasattr(signal, name)
+]
+
+
+def _forward_signal(signum, frame):
+    """
+    Send a signal on to the Sanic worker processes (not eg the process
+    managing their shared state)
+    """
+    for child in multiprocessing.active_children():
+        if child.name.startswith("Sanic-"):
+            os.kill(child.pid, signum)
+
+
 # Default logging.yml file
 logging_yaml_default = """
 # Separate configuration file for logging, since most end-users care less
 # about the details of this
 version: 1
 disable_existing_loggers: false
+# If true, logging calls just queue up records, and a background thread does
+# all the formatting and writing (so the args of logging calls must not be
+# modified afterwards)
+queue: false
 formatters:
     brief:
         format: "%(levelname)s: [%(name)s] %(message)s"
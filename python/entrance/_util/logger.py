@@ -4,10 +4,11 @@
 
 """Logging helpers and utils."""
 
-__all__ = ("FormattedLogRecord",)
+__all__ = ("FormattedLogRecord", "QueuedHandler", "configure", "listen_for_workers")
 
 
-import logging
+import atexit, logging, logging.config, logging.handlers, multiprocessing, queue
+import threading
 
 
 class FormattedLogRecord(logging.LogRecord):
@@ -45,3 +46,184 @@ class FormattedLogRecord(logging.LogRecord):
         if truncation is not None and len(msg) > truncation:
             msg = "".join((msg[: truncation - 3], "..."))
         return msg
+
+
+# Whether configure() has been called in this process
+_configured = False
+
+# The handlers that configure() set up, which are the only ones that records
+# forwarded from worker processes go to (not eg Sanic's own console handlers,
+# which the workers have too)
+_configured_handlers = set()
+
+
+def configure(logging_config, forward_q=None):
+    """
+    Set up logging as per logging.config.dictConfig, and install
+    FormattedLogRecord. Only the first call in each process has any effect.
+
+    The config can also have a "queue" key. If true, then all the configured
+    handlers are moved onto a background thread: each logger's handlers are
+    replaced by a QueuedHandler, so logging calls just enqueue records. Each
+    logger's level is also raised to the lowest level that any of its
+    handlers (including those it propagates to) would emit, so that records
+    nothing would emit aren't even created.
+
+    If a queue from listen_for_workers is given, then this is a worker
+    process, which is set up the same way as for "queue", except that the
+    background thread forwards records to the process that owns the real
+    handlers (so that eg only one process ever rotates a log file).
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    logging.setLogRecordFactory(FormattedLogRecord)
+    logging_config = dict(logging_config)
+    queued = logging_config.pop("queue", False)
+    if forward_q is not None:
+        # Stand-ins for the real handlers, with the same levels, so that the
+        # loggers' levels can be raised to match
+        logging_config["handlers"] = {
+            name: {"class": "logging.NullHandler", "level": cfg.get("level", 0)}
+            for name, cfg in logging_config.get("handlers", {}).items()
+        }
+        logging.config.dictConfig(logging_config)
+        _start_queue(forward_q)
+        return
+    logging.config.dictConfig(logging_config)
+    if queued:
+        _start_queue()
+    _configured_handlers.update(
+        handler for logger in _all_loggers() for handler in logger.handlers
+    )
+
+
+def listen_for_workers():
+    """
+    Handle records forwarded from worker processes (see configure) in a
+    background thread, using this process's loggers and handlers. Returns
+    the queue to pass to the workers.
+    """
+    # Spawn context, as used by Sanic for its worker processes
+    forward_q = multiprocessing.get_context("spawn").Queue()
+    listener = logging.handlers.QueueListener(forward_q, _Dispatcher())
+    listener.start()
+    atexit.register(listener.stop)
+    return forward_q
+
+
+class _Dispatcher(logging.Handler):
+    """
+    Passes a forwarded record to its logger in this process
+    """
+
+    def handle(self, record):
+        logger = logging.getLogger(record.name)
+        while logger is not None:
+            for handler in logger.handlers:
+                if handler in _configured_handlers and record.levelno >= handler.level:
+                    handler.handle(record)
+            logger = logger.parent if logger.propagate else None
+        return True
+
+
+class QueuedHandler(logging.Handler):
+    """
+    Handler that passes records to a background thread, to be handled there
+    by the given handlers. Nothing is formatted in the calling thread, so
+    the args of a logging call mustn't be modified afterwards.
+    """
+
+    def __init__(self, record_q, handlers):
+        super().__init__(min(handler.level for handler in handlers))
+        self.record_q = record_q
+        self.handlers = handlers
+
+    def handle(self, record):
+        # No need for the handler lock, nor to format anything
+        rv = self.filter(record)
+        if rv:
+            self.record_q.put((record, self.handlers))
+        return rv
+
+    def emit(self, record):
+        self.record_q.put((record, self.handlers))
+
+
+def _start_queue(forward_q=None):
+    """
+    Move all configured handlers onto a background thread, or if given a
+    queue from listen_for_workers, replace them with forwarding to it from
+    the background thread
+    """
+    loggers = _all_loggers()
+
+    # Raise levels first, while the handlers are still in place
+    for logger in loggers:
+        level = _lowest_handler_level(logger)
+        if level is not None and logger.getEffectiveLevel() < level:
+            logger.setLevel(level)
+
+    record_q = queue.SimpleQueue()
+    if forward_q is not None:
+        # Formats (and pickles) records, so only in the background thread
+        forwarder = logging.handlers.QueueHandler(forward_q)
+    for logger in loggers:
+        if logger.handlers:
+            handler = QueuedHandler(record_q, logger.handlers)
+            if forward_q is not None:
+                # The receiving process passes each record along the whole
+                # chain of loggers, so it only needs forwarding once
+                handler.handlers = [forwarder]
+                logger.propagate = False
+            logger.handlers = [handler]
+
+    thread = threading.Thread(
+        name="LogWriter", daemon=True, target=_write_records, args=(record_q,)
+    )
+    thread.start()
+
+    def stop():
+        # Write out anything still queued
+        record_q.put(None)
+        thread.join(5)
+
+    atexit.register(stop)
+
+
+def _all_loggers():
+    """
+    The root logger and every logger created so far
+    """
+    return [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+
+
+def _lowest_handler_level(logger):
+    """
+    The lowest level of all the handlers a logger's records can go to, or
+    None if there are none
+    """
+    levels = []
+    while logger is not None:
+        levels.extend(handler.level for handler in logger.handlers)
+        logger = logger.parent if logger.propagate else None
+    return min(levels) if levels else None
+
+
+def _write_records(record_q):
+    """
+    Handle queued records, in the background thread
+    """
+    while True:
+        item = record_q.get()
+        if item is None:
+            return
+        record, handlers = item
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
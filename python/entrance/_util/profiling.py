@@ -0,0 +1,141 @@
+# On-demand profiling
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""On-demand sampling and per-request profiling."""
+
+__all__ = ("SamplingProfiler", "RequestProfiler", "request_profiler")
+
+
+import cProfile, collections, io, marshal, os, pstats, sys, threading, time
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a thread that periodically samples the stacks of
+    all other threads, and counts identical stacks. The result is in the
+    collapsed-stack format used by flame graph tools ("frame;frame;... count"
+    per line, outermost frame first). Sampling stops after the given
+    duration, or when stopped explicitly.
+    """
+
+    def __init__(self, duration, interval=0.005):
+        self.duration = duration
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            name="SamplingProfiler", daemon=True, target=self._run
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def collapsed(self):
+        """
+        The samples so far, as collapsed stacks
+        """
+        return "".join(
+            "{} {}\n".format(stack, count) for stack, count in self.counts.most_common()
+        )
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.duration
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() > deadline:
+                break
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+class RequestProfiler:
+    """
+    Runs cProfile around the handling of chosen req_types, accumulating the
+    stats until collected. Note that cProfile covers the whole event loop
+    thread while enabled, so includes anything else that runs during awaits.
+    """
+
+    def __init__(self):
+        # req_type -> number of requests still to profile
+        self.remaining = {}
+        self.stats = None
+        self.profiled = 0
+        self.active = False
+
+    def arm(self, req_type, count):
+        self.remaining[req_type] = count
+
+    def profile(self, req_type):
+        """
+        Return a started cProfile.Profile if this req_type should be
+        profiled, else None. Only one request is profiled at a time.
+        """
+        count = self.remaining.get(req_type)
+        if not count or self.active:
+            return None
+        if count == 1:
+            del self.remaining[req_type]
+        else:
+            self.remaining[req_type] = count - 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some other profiler is already running
+            return None
+        self.active = True
+        return profile
+
+    def finish(self, profile):
+        """
+        Stop a profile returned by profile(), and add in its stats
+        """
+        profile.disable()
+        self.active = False
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+        self.profiled += 1
+
+    def collect(self, top=30):
+        """
+        Return the accumulated stats as (marshalled pstats data, text summary
+        of the top functions by cumulative time), and start afresh
+        """
+        stats, self.stats = self.stats, None
+        self.profiled = 0
+        if stats is None:
+            return None, ""
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats("cumulative").print_stats(top)
+        return marshal.dumps(stats.stats), summary.getvalue()
+
+
+# The request profiler, if profiling has been turned on by a request (checked
+# by Feature.handle, so that there's no cost otherwise)
+request_profiler = None
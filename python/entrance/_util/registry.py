@@ -0,0 +1,89 @@
+# Lazily-importing name registries
+#
+# Copyright (c) 2018 Ensoft Ltd
+
+"""Lazily-importing name registries."""
+
+__all__ = ("LazyRegistry",)
+
+
+import importlib, logging
+
+log = logging.getLogger(__name__)
+
+
+class LazyRegistry(dict):
+    """
+    Dict mapping names to classes, where a value can instead be given as a
+    "module:attribute" string that is only imported on first lookup. (So use
+    lookups rather than iterating over values.)
+
+    Names that aren't registered are looked for (once) among the installed
+    packages' entry points in the given group, so that third-party packages
+    can provide eg features without being imported up front.
+    """
+
+    def __init__(self, entry_point_group, entries=()):
+        super().__init__(entries)
+        self.entry_point_group = entry_point_group
+        self.entry_points_loaded = False
+
+    def __getitem__(self, name):
+        value = super().__getitem__(name)
+        if isinstance(value, str):
+            value = _import(value)
+            self[name] = value
+        return value
+
+    def __missing__(self, name):
+        if not self.entry_points_loaded:
+            self._load_entry_points()
+            if dict.__contains__(self, name):
+                return self[name]
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def names(self):
+        """
+        All registered names, without importing anything
+        """
+        self._load_entry_points()
+        return list(self.keys())
+
+    def _load_entry_points(self):
+        if not self.entry_points_loaded:
+            self.entry_points_loaded = True
+            for ep in _entry_points(self.entry_point_group):
+                self.setdefault(ep.name, ep.value)
+
+
+def _import(target):
+    """
+    Import a "module:attribute" string
+    """
+    module_name, _, attr = target.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, attr) if attr else module
+
+
+def _entry_points(group):
+    """
+    Installed entry points in a group. (importlib.metadata is itself slow to
+    import, so only do that when needed.)
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        return []
+    try:
+        return entry_points(group=group)
+    except TypeError:  # Python < 3.10
+        return entry_points().get(group, [])
+    except Exception as e:
+        log.warning("Failed to read %s entry points: %s", group, e)
+        return []
@@ -0,0 +1,127 @@
+# Request tracing
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""Lightweight per-request tracing spans."""
+
+__all__ = ("Trace", "WorkerTiming", "current", "span", "configure", "start")
+
+
+import contextvars, time, ujson
+
+# The trace for the request being handled, if any. Being a context variable,
+# this follows the request into any tasks created to handle it.
+current = contextvars.ContextVar("entrance_trace", default=None)
+
+# Local file to write all traces to (as one JSON object per line), if any
+_trace_file = None
+
+
+def configure(trace_file=None):
+    """
+    Trace every request into the given file (or stop, if None)
+    """
+    global _trace_file
+    if _trace_file is not None:
+        _trace_file.close()
+    _trace_file = None if trace_file is None else open(trace_file, "a", buffering=1)
+
+
+def start(request):
+    """
+    Return a new Trace for a request if it asks for one (with a true "trace"
+    field) or we're tracing everything to a file, else None
+    """
+    if request.get("trace") or _trace_file is not None:
+        return Trace(request.get("req_type"))
+    return None
+
+
+class Trace:
+    """
+    Timed spans of the handling of one request. Spans with the same name
+    (eg for each recv from a connection) are added together in the summary.
+    """
+
+    __slots__ = ("req_type", "start", "wall_start", "spans", "finished")
+
+    def __init__(self, req_type):
+        self.req_type = req_type
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans = []
+        self.finished = False
+
+    def add(self, name, start, end):
+        # Ignore spans after we're done (eg from long-lived tasks that were
+        # started while handling the request, and so inherited the trace)
+        if not self.finished:
+            self.spans.append((name, start, end))
+
+    def summary(self):
+        """
+        Time in each phase (in ms), plus the total so far
+        """
+        phases = {}
+        for name, start, end in self.spans:
+            phases[name] = phases.get(name, 0) + end - start
+        return {
+            "phases": {name: _ms(secs) for name, secs in phases.items()},
+            "total": _ms(time.perf_counter() - self.start),
+        }
+
+    def finish(self):
+        """
+        Stop recording, and write the trace out if tracing to a file. Each
+        span is written as its name, start offset and duration (in ms).
+        """
+        self.finished = True
+        if _trace_file is not None:
+            record = {
+                "req_type": self.req_type,
+                "time": self.wall_start,
+                "spans": [
+                    (name, _ms(start - self.start), _ms(end - start))
+                    for name, start, end in self.spans
+                ],
+            }
+            record.update(self.summary())
+            _trace_file.write(ujson.dumps(record) + "\n")
+
+
+def _ms(secs):
+    return round(secs * 1000, 3)
+
+
+class WorkerTiming:
+    """
+    Timestamps filled in by a connection's worker thread for one request
+    """
+
+    __slots__ = ("queued", "started", "finished")
+
+    def __init__(self):
+        self.queued = time.perf_counter()
+        self.started = None
+        self.finished = None
+
+
+class span:
+    """
+    Context manager that adds a span to the current trace, if any
+    """
+
+    __slots__ = ("name", "trace", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = current.get()
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, time.perf_counter())
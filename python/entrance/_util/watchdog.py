@@ -0,0 +1,97 @@
+# Event loop lag watchdog
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""Event loop lag watchdog."""
+
+__all__ = ("LoopWatchdog",)
+
+
+import asyncio, logging, sys, threading, time, traceback
+
+from .. import metrics
+
+log = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag continuously: a task on the loop wakes up every
+    interval and records how late it was. Separately, a thread checks that
+    the task keeps waking up, and if the loop has been stuck for longer than
+    the threshold, logs the stack of whatever is running on it (and which
+    feature and req_type it is handling, if any). That is logged once per
+    stall, while the blocking code is still running.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.task = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.ensure_future(self._beat())
+        self.thread = threading.Thread(
+            name="LoopWatchdog", daemon=True, target=self._watch
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0)
+            metrics.loop_lag.observe((), lag)
+            metrics.loop_lag_recent.append(lag)
+            self.last_beat = now
+
+    def _watch(self):
+        reported_beat = None
+        while not self.stop_event.wait(self.interval):
+            beat = self.last_beat
+            stuck = time.monotonic() - beat - self.interval
+            if stuck > self.threshold and beat != reported_beat:
+                reported_beat = beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self._report(stuck, frame)
+
+    def _report(self, stuck, frame):
+        """
+        Log the stack of the blocking code, plus the request being handled
+        """
+        handling = _find_request(frame)
+        log.warning(
+            "Event loop blocked for over %.3fs%s, at:\n%s",
+            stuck,
+            " handling {} {}".format(*handling) if handling else "",
+            "".join(traceback.format_stack(frame)),
+        )
+
+
+def _find_request(frame):
+    """
+    Look for a Feature.handle call on the stack, and return its feature name
+    and req_type
+    """
+    while frame is not None:
+        if frame.f_code.co_name == "handle":
+            f_locals = frame.f_locals
+            feature = f_locals.get("self")
+            if "req_type" in f_locals and hasattr(feature, "dispatch"):
+                return feature.name, f_locals["req_type"]
+        frame = frame.f_back
+    return None
@@ -1,5 +1,21 @@
 from .base import *
-from .ssh import *
+from .._util.registry import LazyRegistry
 
-# Map of connection type strings to factory classes
-connection_factory_by_name = {"ssh": SSHConnectionFactory}
+# Map of connection type strings to factory classes. Imported only when first
+# used, since they can have heavy dependencies; further connection types can
+# be provided by other packages via "entrance.connections" entry points.
+connection_factory_by_name = LazyRegistry(
+    "entrance.connections",
+    {
+        "ssh": "entrance.connection.ssh:SSHConnectionFactory",
+    },
+)
+
+
+def __getattr__(name):
+    """
+    Import factory classes on demand
+    """
+    if name == "SSHConnectionFactory":
+        return connection_factory_by_name["ssh"]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
@@ -5,6 +5,7 @@
 import logging
 from enum import IntEnum, unique
 
+from .. import metrics
 from .._util import events
 
 
@@ -36,6 +37,10 @@ class ConnectionFactory:
     same router, that can be used for different purposes concurrently.
     """
 
+    # Pool of worker processes that connections are run in, if any (set by
+    # sharded.ShardPool.start)
+    shard_pool = None
+
     def __init__(self, **kwargs):
         self.kwargs = kwargs
 
@@ -44,7 +49,8 @@ class ConnectionFactory:
         Create a new CLI exec connection, and return a corresponding
         CLIConnection object
         """
-        con = self.cli_connection_cls(self, connection_name, finalizer)
+        con_cls = self._connection_cls(self.cli_connection_cls)
+        con = con_cls(self, connection_name, finalizer)
         await con.connect(**self.kwargs)
         return con
 
@@ -53,10 +59,20 @@ class ConnectionFactory:
         Create a new Netconf connection, and return a corresponding
         NetconfConnection object
         """
-        con = self.netconf_connection_cls(self, connection_name, finalizer)
+        con_cls = self._connection_cls(self.netconf_connection_cls)
+        con = con_cls(self, connection_name, finalizer)
         await con.connect(**self.kwargs)
         return con
 
+    def _connection_cls(self, cls):
+        """
+        The class to create a connection with: the given one, or a proxy for
+        it if connections are run in a pool of worker processes
+        """
+        if self.shard_pool is None:
+            return cls
+        return self.shard_pool.proxy_cls(cls)
+
 
 class Connection:
     """
@@ -66,9 +82,10 @@ class Connection:
     # Internal attributes:
     #
     # _log
-    #   Logger object
+    #   Logger object, shared by all connections (so messages should include
+    #   the connection name)
     #
-    _log = None
+    _log = logging.getLogger(__name__)
 
     def __init__(self, factory, name, finalizer, **kwargs):
         self.factory = factory
@@ -77,9 +94,7 @@ class Connection:
         self.state = ConState.DISCONNECTED
         self.kwargs = kwargs
         self.state_listeners = []
-        self._log = logging.getLogger(
-            "{}.{}-{}".format(__name__, type(self).__name__, name)
-        )
+        metrics.connections.add(self)
 
     def add_state_listener(self, listener):
         """
@@ -87,6 +102,12 @@ class Connection:
         """
         self.state_listeners.append(listener)
 
+    def remove_state_listener(self, listener):
+        """
+        Stop notifying a callback previously added with add_state_listener
+        """
+        self.state_listeners.remove(listener)
+
     async def connect(self):
         # documentation only, implemented by subclasses
         pass
@@ -103,10 +124,17 @@ class Connection:
         # Actually change state and then notify listeners.
         old_state = self.state
         self.state = state
-        for listener in self.state_listeners:
-            await listener(self)
+        # Iterate over a copy, as listeners can remove themselves, and don't
+        # let one failing listener stop the others (or the finalizer)
+        for listener in list(self.state_listeners):
+            try:
+                await listener(self)
+            except Exception:
+                self._log.exception("%s state listener %r failed", self.name, listener)
         self._log.debug(
-            "changed state from %s to %s; notified %d listeners",
+            "%s %s changed state from %s to %s; notified %d listeners",
+            type(self).__name__,
+            self.name,
             old_state.name,
             state.name,
             len(self.state_listeners),
@@ -116,10 +144,10 @@ class Connection:
         if state == ConState.FINALIZING:
 
             async def finalize():
-                self._log.debug("started finalizing")
+                self._log.debug("%s started finalizing", self.name)
                 if self.finalizer is not None:
                     await self.finalizer()
                 await self._set_state(ConState.CONNECTED)
-                self._log.debug("finished finalizing")
+                self._log.debug("%s finished finalizing", self.name)
 
             events.create_checked_task(finalize())
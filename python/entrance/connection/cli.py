@@ -2,8 +2,9 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import re
+import asyncio, re
 from entrance.connection.threaded import ThreadedConnection
+from .._util import tracing
 
 
 class ThreadedCLIConnection(ThreadedConnection):
@@ -37,19 +38,35 @@ class ThreadedCLIConnection(ThreadedConnection):
     _prompt = re.compile(r"(.*)RP/0/(RP)?0/CPU0:[^\r\n]*?#", re.DOTALL)
     _interesting = re.compile(r"[^\n]*\n[^\n]* UTC\r\n(.*)", re.DOTALL)
 
-    async def expect_prompt(self, strip_top=False, override=False):
+    async def expect_prompt(self, strip_top=False, override=False, timeout=None):
         """
         Waits for a prompt, and returns all the characters up to that point
-        (optionally also stripping off an initial line and timestamp)
+        (optionally also stripping off an initial line and timestamp). If no
+        prompt arrives within the timeout (if given), raises
+        asyncio.TimeoutError, and the worker thread resyncs the session.
         """
+        if timeout is not None:
+            return await asyncio.wait_for(
+                self.expect_prompt(strip_top, override), timeout
+            )
         buf = bytes()
         while True:
             buf += await self.recv(override=override)
-            m = self._prompt.match(buf.decode())
-            if m:
-                result = m.group(1)
-                if strip_top:
-                    m = self._interesting.match(result)
-                    if m:
-                        result = m.group(1)
+            with tracing.span("expect_prompt parse"):
+                result = self._match_prompt(buf, strip_top)
+            if result is not None:
                 return result
+
+    def _match_prompt(self, buf, strip_top):
+        """
+        Return the output before the prompt (see expect_prompt), or None if
+        no prompt yet
+        """
+        m = self._prompt.match(buf.decode())
+        if m:
+            result = m.group(1)
+            if strip_top:
+                m = self._interesting.match(result)
+                if m:
+                    result = m.group(1)
+            return result
@@ -11,6 +11,15 @@ class ThreadedNCConnection(ThreadedConnection):
     is a ncclient.manager session. Just add a connection.
     """
 
+    # Internal attributes:
+    #
+    # _candidate_clean
+    #   True if the candidate datastore is known to match running (ie after a
+    #   successful commit or discard-changes), so there is nothing to discard.
+    #   Only ever touched from the worker thread.
+    #
+    _candidate_clean = False
+
     async def get(self, xml_filter, override=False):
         """
         Issue a Netconf "get" request in the worker thread
@@ -49,6 +58,64 @@ class ThreadedNCConnection(ThreadedConnection):
         """
         return await self._request("discard_changes", override)
 
+    async def transaction(self, ops, override=False):
+        """
+        Issue a sequence of operations in the worker thread in one go, stopping
+        at the first one that fails. The ops are a list of (op, args) pairs, eg
+        [("edit_config", [xml]), ("commit", [])]. Returns a list of (op,
+        rpc_reply) pairs for the operations actually attempted.
+        """
+        # An empty get-config filter means no filter, as per get_config
+        ops = [
+            (op, [None]) if op == "get_config" and args[0].strip() == "" else (op, args)
+            for op, args in ops
+        ]
+        return await self._request("transaction", override, ops)
+
+    @staticmethod
+    def reply_ok(op, rpc_reply):
+        """
+        Decide whether an rpc_reply counts as success for the given op
+        """
+        # Semi-hack for commit check:
+        #
+        # If a validate operation returns errors, but they all have
+        # severity 'warning' not 'error', then consider the operation
+        # a success
+        if op == "validate" and not rpc_reply.ok:
+            return "<error-severity>error</error-severity>" not in str(rpc_reply)
+        return rpc_reply.ok
+
+    @staticmethod
+    def project(rpc_reply, select):
+        """
+        Reduce an rpc_reply to a JSONable projection, as specified by a select
+        dict with these (all optional) keys:
+
+        - "xpath": expression picking out the nodes of interest (default is
+          the document root)
+        - "namespaces": prefix -> URI map for use in the xpath
+        - "fields": list of leaves to extract from each node, each being a
+          "/"-separated path of local names (so no namespace prefixes needed)
+
+        The result is a list with one entry per selected node: a dict of the
+        requested fields, or if no fields were specified then the whole
+        subtree converted to nested dicts. This parses XML, so is best run off
+        the event loop.
+        """
+        # Only needed here, so not imported by everything using connections
+        from ncclient.xml_ import to_ele
+
+        root = to_ele(rpc_reply.xml)
+        nodes = root.xpath(
+            select.get("xpath", "/*"), namespaces=select.get("namespaces", None)
+        )
+        if not isinstance(nodes, list):
+            # Scalar xpath result, eg from count()
+            return nodes
+        fields = select.get("fields", None)
+        return [_project_node(node, fields) for node in nodes]
+
     def _handle_get(self, xml_filter):
         """
         Netconf "get" request
@@ -65,14 +132,19 @@ class ThreadedNCConnection(ThreadedConnection):
         """
         Netconf "edit-config" request
         """
-        self._handle_discard_changes()
+        if not self._candidate_clean:
+            self._handle_discard_changes()
+        self._candidate_clean = False
         return self.mgr.edit_config(target="candidate", config=xml_config)
 
     def _handle_commit(self):
         """
         Netconf "commit" request
         """
-        return self.mgr.commit()
+        rpc_reply = self.mgr.commit()
+        if rpc_reply.ok:
+            self._candidate_clean = True
+        return rpc_reply
 
     def _handle_validate(self):
         """
@@ -84,4 +156,56 @@ class ThreadedNCConnection(ThreadedConnection):
         """
         Discard current changes
         """
-        return self.mgr.discard_changes()
+        rpc_reply = self.mgr.discard_changes()
+        self._candidate_clean = rpc_reply.ok
+        return rpc_reply
+
+    def _handle_transaction(self, ops):
+        """
+        Run a sequence of operations back to back, stopping on first failure
+        """
+        results = []
+        for op, args in ops:
+            rpc_reply = getattr(self, "_handle_" + op)(*args)
+            results.append((op, rpc_reply))
+            if not self.reply_ok(op, rpc_reply):
+                break
+        return results
+
+
+def _project_node(node, fields):
+    """
+    Project one xpath result node
+    """
+    if isinstance(node, str):
+        # Text or attribute result
+        return str(node)
+    if fields is None:
+        return _ele_to_json(node)
+    projection = {}
+    for field in fields:
+        path = "/".join("*[local-name()='{}']".format(p) for p in field.split("/"))
+        matches = node.xpath(path)
+        projection[field] = _ele_to_json(matches[0]) if matches else None
+    return projection
+
+
+def _ele_to_json(ele):
+    """
+    Convert an element to a leaf string, or a dict keyed by child local names
+    (with a list value for any repeated children)
+    """
+    children = [child for child in ele if isinstance(child.tag, str)]
+    if not children:
+        return (ele.text or "").strip()
+    result = {}
+    for child in children:
+        key = child.tag.rpartition("}")[2]
+        value = _ele_to_json(child)
+        if key not in result:
+            result[key] = value
+        elif isinstance(result[key], list):
+            result[key].append(value)
+        else:
+            result[key] = [result[key], value]
+    return result
@@ -0,0 +1,322 @@
+# Record and replay router sessions
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""
+Record connections' sessions with real routers into transcripts, and replay
+them later without any router at all.
+
+A transcript is a file of JSON lines, one per request carried out by a
+connection's worker thread: the session (connection name and number), the
+action (eg "send", "recv" or "get_config"), its arguments, the result and
+how long it took. Replaying serves up the recorded results in order,
+optionally speeding up or slowing down the recorded timings, which makes
+for deterministic benchmarks of everything above the connection.
+
+Neither recording nor replaying is a connection type by default, since they
+write and read files named by the client. Register them explicitly to use
+them, eg:
+
+    connection_factory_by_name["record"] = RecordingConnectionFactory
+    connection_factory_by_name["replay"] = ReplayConnectionFactory
+
+To record, connect with the params for the recorded connection type (default
+"ssh", else given as "record_connection_type") plus "transcript".
+
+To replay, connect with a "transcript" param (the filename) and an optional
+"time_scale" (default 1: recorded timings; 0: no delays). Each new
+connection replays the next recorded session with the same name (across all
+the factories replaying the transcript, so eg recording N routers then
+replaying N routers gives each the session of the corresponding router),
+going back to the first once they have all been used. The transcript is read
+by the first connection's worker thread, rather than on the event loop.
+"""
+
+__all__ = ("ReplayConnectionFactory", "RecordingConnectionFactory")
+
+
+import collections, functools, threading, time, ujson
+
+from . import connection_factory_by_name
+from .base import ConnectionFactory, ConState
+from .cli import ThreadedCLIConnection
+from .netconf import ThreadedNCConnection
+
+
+class ReplayError(Exception):
+    pass
+
+
+#
+# Recording
+#
+class _Transcript:
+    """
+    Transcript file being written, shared by all the connections recording
+    into it
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, "a", buffering=1)
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def new_session(self, name):
+        with self.lock:
+            count = self.sessions.get(name, 0)
+            self.sessions[name] = count + 1
+        return "{}#{}".format(name, count)
+
+    def write(self, record):
+        line = ujson.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+
+class _RecordingMixin:
+    """
+    Records every request to a ThreadedConnection into the factory's
+    transcript
+    """
+
+    def __init__(self, factory, name, finalizer=None):
+        super().__init__(factory, name, finalizer)
+        self.session = factory.transcript.new_session(name)
+
+    def _handle_connect(self, **creds):
+        # Not recording the creds!
+        base = super(_RecordingMixin, self)
+        self._record("connect", (), lambda: base._handle_connect(**creds))
+
+    def _do_request(self, action, args):
+        base = super(_RecordingMixin, self)
+        return self._record(action, args, lambda: base._do_request(action, args))
+
+    def _record(self, action, args, fn):
+        record = {"session": self.session, "action": action, "args": args}
+        start = time.perf_counter()
+        try:
+            result = fn()
+            record["result"] = encode_result(result)
+            return result
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["duration"] = round(time.perf_counter() - start, 6)
+            self.factory.transcript.write(record)
+
+
+@functools.lru_cache()
+def _open_transcript(filename):
+    return _Transcript(filename)
+
+
+@functools.lru_cache()
+def _recording_cls(cls):
+    """
+    Recording version of a ThreadedConnection class
+    """
+    return type("Recording" + cls.__name__, (_RecordingMixin, cls), {})
+
+
+class RecordingConnectionFactory(ConnectionFactory):
+    """
+    ConnectionFactory that wraps the factory for another connection type,
+    recording all its connections' sessions
+    """
+
+    def __init__(self, transcript, record_connection_type="ssh", **kwargs):
+        super().__init__(**kwargs)
+        self.transcript = _open_transcript(transcript)
+        factory_cls = connection_factory_by_name[record_connection_type]
+        self.cli_connection_cls = _recording_cls(factory_cls.cli_connection_cls)
+        self.netconf_connection_cls = _recording_cls(factory_cls.netconf_connection_cls)
+
+
+#
+# Replaying
+#
+class _ReplayMixin:
+    """
+    Serves each request to a ThreadedConnection from a recorded session
+    """
+
+    def __init__(self, factory, name, finalizer=None):
+        super().__init__(factory, name, finalizer)
+        # Which session to replay is decided now, so that it doesn't depend on
+        # the order that worker threads start in, but the transcript is only
+        # read in the worker thread
+        self.session_number = factory.next_session_number(name)
+        self.records = None
+        self.position = 0
+        self.timeout = None
+
+    def _handle_connect(self, **creds):
+        if self.records is None:
+            self.records = self.factory.session_records(
+                self.name, self.session_number
+            )
+        if not self.records:
+            raise ReplayError("No recorded sessions for {}".format(self.name))
+        # Start from the next recorded connect (from the top, if none left)
+        connects = [
+            i
+            for i, record in enumerate(self.records)
+            if record["action"] == "connect"
+        ]
+        self.position = next((i for i in connects if i >= self.position), 0)
+        self._replay("connect")
+        self._update_state(ConState.FINALIZING)
+
+    def _handle_disconnect(self):
+        self._update_state(ConState.DISCONNECTED)
+        self.terminate = True
+
+    def _do_request(self, action, args):
+        if action == "disconnect":
+            return self._handle_disconnect()
+        if action == "settimeout":
+            self.timeout = args[0]
+        return self._replay(action)
+
+    def _replay(self, action):
+        """
+        Return (or raise) the next recorded result, after the recorded time
+        """
+        if self.position >= len(self.records) or (
+            self.records[self.position]["action"] == "connect" and action != "connect"
+        ):
+            # Nothing more recorded in this session
+            if action == "recv" and self.timeout is not None:
+                time.sleep(self.timeout)
+                return bytes()
+            raise ReplayError("End of recorded session for {}".format(self.name))
+        record = self.records[self.position]
+        if record["action"] != action:
+            raise ReplayError(
+                "Recorded session for {} has {} rather than {}".format(
+                    self.name, record["action"], action
+                )
+            )
+        self.position += 1
+        delay = record["duration"] * self.factory.time_scale
+        if delay > 0:
+            time.sleep(delay)
+        if "error" in record:
+            raise ReplayError(record["error"])
+        return decode_result(record["result"])
+
+
+class ReplayCLIConnection(_ReplayMixin, ThreadedCLIConnection):
+    """
+    CLI connection replaying a recorded session
+    """
+
+
+class ReplayNCConnection(_ReplayMixin, ThreadedNCConnection):
+    """
+    Netconf connection replaying a recorded session
+    """
+
+
+class ReplayConnectionFactory(ConnectionFactory):
+    """
+    ConnectionFactory whose connections replay recorded sessions
+    """
+
+    cli_connection_cls = ReplayCLIConnection
+    netconf_connection_cls = ReplayNCConnection
+
+    def __init__(self, transcript, time_scale=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.transcript = transcript
+        self.time_scale = float(time_scale)
+
+    def next_session_number(self, name):
+        """
+        Count a new connection with the given name, returning how many there
+        were before it
+        """
+        key = (self.transcript, name)
+        number = _session_counts[key]
+        _session_counts[key] += 1
+        return number
+
+    def session_records(self, name, number):
+        """
+        Records for the numbered connection with the given name. This reads
+        the transcript if not yet read, so is called from worker threads.
+        """
+        with _load_lock:
+            by_name = _load_transcript(self.transcript)
+        recorded = by_name.get(name, [])
+        return recorded[number % len(recorded)] if recorded else []
+
+
+# Connections created so far, by (transcript, connection name)
+_session_counts = collections.Counter()
+
+# Held while reading a transcript, so that it is only read once
+_load_lock = threading.Lock()
+
+
+def _session_order(item):
+    name, _, number = item[0].rpartition("#")
+    return name, int(number)
+
+
+@functools.lru_cache()
+def _load_transcript(filename):
+    """
+    Read a transcript into lists of sessions' records, by connection name
+    (just once, since typically many factories replay the same transcript)
+    """
+    sessions = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                record = ujson.loads(line)
+                sessions.setdefault(record["session"], []).append(record)
+    by_name = {}
+    for session, records in sorted(sessions.items(), key=_session_order):
+        name = session.rpartition("#")[0]
+        by_name.setdefault(name, []).append(records)
+    return by_name
+
+
+#
+# Results in transcripts (and passed between processes, see sharded.py)
+#
+def encode_result(result):
+    """
+    JSON-friendly encoding of a request result
+    """
+    if isinstance(result, bytes):
+        return {"bytes": result.decode("latin-1")}
+    if isinstance(result, list):
+        # Netconf transaction
+        return {"list": [[op, encode_result(reply)] for op, reply in result]}
+    if hasattr(result, "xml"):
+        # ncclient RPCReply
+        return {"rpc_reply": result.xml, "cls": type(result).__name__}
+    return {"value": result}
+
+
+def decode_result(encoded):
+    """
+    Reverse encode_result
+    """
+    if "bytes" in encoded:
+        return encoded["bytes"].encode("latin-1")
+    if "list" in encoded:
+        return [(op, decode_result(reply)) for op, reply in encoded["list"]]
+    if "rpc_reply" in encoded:
+        from ncclient.operations.retrieve import GetReply
+        from ncclient.operations.rpc import RPCReply
+
+        cls = GetReply if encoded["cls"] == "GetReply" else RPCReply
+        reply = cls(encoded["rpc_reply"])
+        reply.parse()
+        return reply
+    return encoded["value"]
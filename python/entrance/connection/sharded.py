@@ -0,0 +1,451 @@
+# Run connections in a pool of worker processes
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""
+Run the worker threads of ThreadedConnections in a pool of subprocesses,
+rather than in the server process, so that the SSH crypto and XML handling
+for many routers isn't all competing for one GIL.
+
+Each worker process owns a shard of the routers (chosen by host, port and
+username, so all the connections to a router share a process), and runs the
+real connections there. In the server process, each connection is a proxy,
+with the same class (and so API) apart from passing its requests to its
+worker process, and getting back their results and its state changes. The
+only difference visible to features is that the factory and the connection
+requests' arguments and results get pickled along the way.
+
+The processes talk over their stdin and stdout, with each message a pickled
+tuple preceded by its length:
+
+    ("logging", levels)                              to the worker
+    ("connect", con_id, cls, name, factory, kwargs)  to the worker
+    ("request", req_id, con_id, action, args)        to the worker
+    ("cancel", req_id, con_id)                       to the worker
+    ("state", con_id, state, failure_reason)         from the worker
+    ("result", req_id, kind, value)                  from the worker
+    ("log", record)                                  from the worker
+
+Log records from the worker processes are handled in the server process
+(which tells them the levels of its loggers, so they only pass on records
+that it would handle), so that only one process writes to the log files.
+
+Enable it by setting "connection_processes" in the start config to the
+number of worker processes.
+"""
+
+__all__ = ("ShardPool",)
+
+
+import asyncio, functools, itertools, logging, os, pickle, signal, struct, sys, time
+
+from .base import ConnectionFactory, ConState
+from .replay import decode_result, encode_result
+from .threaded import ConnectionError, ThreadedConnection
+from .. import metrics
+from .._util import events, logger, tracing
+
+log = logging.getLogger(__name__)
+
+# Message header: length of the pickled message
+_HEADER = struct.Struct("!I")
+
+# Kinds of result
+_RESULT, _ENCODED_RESULT, _ERROR = range(3)
+
+
+class ShardPool:
+    """
+    Pool of worker processes to run connections in
+    """
+
+    def __init__(self, size):
+        self.shards = [_Shard(n) for n in range(size)]
+
+    async def start(self):
+        """
+        Start the worker processes, and have all new connections use them
+        """
+        for shard in self.shards:
+            await shard.start()
+        ConnectionFactory.shard_pool = self
+
+    async def stop(self):
+        """
+        Stop the worker processes (along with all their connections)
+        """
+        if ConnectionFactory.shard_pool is self:
+            ConnectionFactory.shard_pool = None
+        for shard in self.shards:
+            await shard.stop()
+
+    def proxy_cls(self, cls):
+        return _proxy_cls(cls)
+
+    def shard(self, kwargs):
+        """
+        The shard for a router with the given connection params
+        """
+        key = (
+            kwargs.get("host", None),
+            str(kwargs.get("ssh_port", "22")),
+            kwargs.get("username", None),
+        )
+        return self.shards[hash(key) % len(self.shards)]
+
+
+class _ShardedMixin:
+    """
+    Proxy for a ThreadedConnection, whose worker thread runs in a worker
+    process instead
+    """
+
+    async def connect(self, **kwargs):
+        """
+        Initiate a connection, in the router's worker process
+        """
+        self.terminate = False
+        self.shard = self.factory.shard_pool.shard(kwargs)
+        self.event_loop_task = events.create_checked_task(self._event_loop())
+        self.shard.connect(self, kwargs)
+
+    async def disconnect(self):
+        await super().disconnect()
+        self.terminate = True
+        self.shard.forget(self)
+
+    async def _request(self, action, override, *args):
+        """
+        Pass a request to the worker process
+        """
+        self._check_request(action, override, args)
+        start = time.perf_counter()
+        fut = asyncio.Future()
+        req_id = self.shard.request(self, fut, action, args)
+        try:
+            await asyncio.wait([fut])
+        except asyncio.CancelledError:
+            # Cancel the request in the worker process too, which passes it
+            # on to the worker thread
+            fut.cancel()
+            self.shard.cancel(self, req_id)
+            raise
+        end = time.perf_counter()
+        metrics.connection_request_latency.observe(
+            (type(self).__name__, action), end - start
+        )
+        trace = tracing.current.get()
+        if trace is not None:
+            trace.add(action + " worker process", start, end)
+        return fut.result()
+
+
+@functools.lru_cache()
+def _proxy_cls(cls):
+    """
+    Proxy version of a connection class, if it can be run in a worker process
+    (ie it's a ThreadedConnection that can be pickled by name)
+    """
+    if not issubclass(cls, ThreadedConnection) or cls is not _importable(cls):
+        return cls
+    return type("Sharded" + cls.__name__, (_ShardedMixin, cls), {"real_cls": cls})
+
+
+def _importable(cls):
+    module = sys.modules.get(cls.__module__)
+    return getattr(module, cls.__qualname__, None)
+
+
+class _Shard:
+    """
+    A worker process, and the proxies for the connections it runs
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.read_task = None
+        self.stopping = False
+        self.ids = itertools.count()
+        self.connections = {}
+        self.requests = {}
+
+    async def start(self):
+        # The worker process gets the same module search path as this one
+        path = os.pathsep.join(p for p in sys.path if p)
+        env = dict(os.environ, PYTHONPATH=path)
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            "from entrance.connection.sharded import worker_main; worker_main()",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        log.info(
+            "Started connection worker process %d (pid %d)",
+            self.index,
+            self.process.pid,
+        )
+        self._send(("logging", _logger_levels()))
+        self.read_task = events.create_checked_task(self._read_loop())
+
+    async def stop(self):
+        self.stopping = True
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+        await self.read_task
+
+    def connect(self, con, kwargs):
+        con.con_id = next(self.ids)
+        self.connections[con.con_id] = con
+        self._send(
+            ("connect", con.con_id, con.real_cls, con.name, con.factory, kwargs)
+        )
+
+    def forget(self, con):
+        self.connections.pop(con.con_id, None)
+
+    def request(self, con, fut, action, args):
+        req_id = next(self.ids)
+        self.requests[req_id] = (con, fut)
+        self._send(("request", req_id, con.con_id, action, args))
+        return req_id
+
+    def cancel(self, con, req_id):
+        self.requests.pop(req_id, None)
+        self._send(("cancel", req_id, con.con_id))
+
+    def _send(self, msg):
+        self.process.stdin.write(_pack(msg))
+
+    async def _read_loop(self):
+        """
+        Pass state changes and results to the proxies, which handle them just
+        as a ThreadedConnection does those from its worker thread
+        """
+        while True:
+            try:
+                msg = await _read_message(self.process.stdout)
+            except asyncio.IncompleteReadError:
+                break
+            if msg[0] == "log":
+                record = logging.makeLogRecord(msg[1])
+                logging.getLogger(record.name).handle(record)
+            elif msg[0] == "state":
+                _, con_id, state, failure_reason = msg
+                con = self.connections.get(con_id)
+                if con is not None:
+                    state = ConState(state)
+                    if failure_reason is not None:
+                        state.failure_reason = failure_reason
+                    con.result_q.put_nowait((state, None))
+            else:
+                _, req_id, kind, value = msg
+                try:
+                    con, fut = self.requests.pop(req_id)
+                except KeyError:
+                    # Cancelled
+                    continue
+                if kind == _ENCODED_RESULT:
+                    value = decode_result(value)
+                con.result_q.put_nowait((value, fut))
+        if not self.stopping:
+            await self._restart()
+
+    async def _restart(self):
+        """
+        The worker process has died: fail all its connections, and start a
+        new one
+        """
+        log.error("Connection worker process %d exited", self.index)
+        for con, fut in self.requests.values():
+            con.result_q.put_nowait((ConnectionError("Worker process exited"), fut))
+        self.requests = {}
+        state = ConState.FAILED_TO_CONNECT
+        state.failure_reason = "Worker process exited"
+        for con in self.connections.values():
+            con.result_q.put_nowait((state, None))
+        self.connections = {}
+        await self.process.wait()
+        await self.start()
+
+
+def _logger_levels():
+    """
+    The levels of the root logger, and all the others that have one set
+    """
+    levels = {"": logging.root.level}
+    for name, named in logging.root.manager.loggerDict.items():
+        if isinstance(named, logging.Logger) and named.level != logging.NOTSET:
+            levels[name] = named.level
+    return levels
+
+
+def _pack(msg):
+    data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+
+async def _read_message(reader):
+    (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+#
+# Worker process
+#
+def worker_main():
+    """
+    Entry point of a worker process
+    """
+    # Keep stdout for messages, with anything else printed going to stderr
+    # instead
+    msg_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    # The server process decides when we're done (by closing our stdin), even
+    # if signals for it reach us too (eg Ctrl-C, or stopping its whole
+    # process group)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_Worker().run(sys.stdin.fileno(), msg_fd))
+
+
+class _Worker:
+    """
+    Runs the real connections for the proxies in the server process
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.requests = {}
+        self.transport = None
+
+    async def run(self, in_fd, out_fd):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), open(in_fd, "rb", 0)
+        )
+        self.transport, _ = await loop.connect_write_pipe(
+            asyncio.Protocol, open(out_fd, "wb", 0)
+        )
+        while True:
+            try:
+                msg = await _read_message(reader)
+            except asyncio.IncompleteReadError:
+                # Server process has finished with us
+                break
+            if msg[0] == "request":
+                task = events.create_checked_task(self._request(*msg[1:]))
+                self.requests[msg[1]] = task
+            elif msg[0] == "cancel":
+                self._cancel(*msg[1:])
+            elif msg[0] == "connect":
+                events.create_checked_task(self._connect(*msg[1:]))
+            elif msg[0] == "logging":
+                self._forward_logs(msg[1])
+
+    async def _connect(self, con_id, cls, name, factory, kwargs):
+        async def forward_state(con):
+            # The finalizer runs in the server process, which sets the
+            # connection to CONNECTED after it
+            if con.state != ConState.CONNECTED:
+                failure_reason = getattr(con.state, "failure_reason", None)
+                self._send(("state", con_id, int(con.state), failure_reason))
+
+        try:
+            con = cls(factory, name)
+        except Exception as e:
+            log.error("Failed to create connection %s: %s", name, e)
+            self._send(("state", con_id, int(ConState.FAILED_TO_CONNECT), str(e)))
+            return
+        con.add_state_listener(forward_state)
+        self.connections[con_id] = con
+        await con.connect(**kwargs)
+
+    async def _request(self, req_id, con_id, action, args):
+        con = self.connections.get(con_id)
+        try:
+            if con is None:
+                raise ConnectionError("No such connection")
+            # The server process has already checked the connection's state
+            result = await con._request(action, True, *args)
+            if isinstance(result, list) or hasattr(result, "xml"):
+                # ncclient replies can't be pickled
+                reply = ("result", req_id, _ENCODED_RESULT, encode_result(result))
+            else:
+                reply = ("result", req_id, _RESULT, result)
+        except Exception as e:
+            reply = ("result", req_id, _ERROR, e)
+        finally:
+            # Done with (or cancelled)
+            del self.requests[req_id]
+        try:
+            self._send(reply)
+        except Exception:
+            # Result (probably an exception) that can't be pickled
+            error = ConnectionError(str(reply[3]))
+            self._send(("result", req_id, _ERROR, error))
+        if action == "disconnect" and con is not None:
+            con.event_loop_task.cancel()
+            del self.connections[con_id]
+
+    def _cancel(self, req_id, con_id):
+        task = self.requests.get(req_id)
+        if task is not None:
+            task.cancel()
+        elif con_id in self.connections:
+            # Too late to cancel the request itself, but whatever was going to
+            # follow it won't now
+            self.connections[con_id].resync_needed = True
+
+    def _send(self, msg):
+        self.transport.write(_pack(msg))
+
+    def _forward_logs(self, levels):
+        """
+        Pass on log records to the server process, for those of its loggers'
+        levels
+        """
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+        logging.root.addHandler(_ForwardingHandler(self.transport))
+        logging.setLogRecordFactory(logger.FormattedLogRecord)
+
+
+class _ForwardingHandler(logging.Handler):
+    """
+    Sends log records from a worker process to the server process
+    """
+
+    def __init__(self, transport):
+        super().__init__()
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+
+    def emit(self, record):
+        try:
+            # Just the message, since the args might not pickle (or might
+            # change before the event loop gets to it)
+            attrs = dict(record.__dict__, msg=record.getMessage(), args=None)
+            if record.exc_info:
+                attrs["exc_text"] = _exc_formatter.formatException(record.exc_info)
+            attrs["exc_info"] = None
+            data = _pack(("log", attrs))
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.transport.write, data)
+        except RuntimeError:
+            # Event loop closed, so the server process has finished with us
+            pass
+
+
+_exc_formatter = logging.Formatter()
+
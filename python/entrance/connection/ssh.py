@@ -2,7 +2,7 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import os, socket, sys, time
+import os, socket, sys, threading, time
 
 try:
     import paramiko
@@ -11,6 +11,7 @@ try:
     from entrance.connection.base import ConnectionFactory, ConState
     from entrance.connection.cli import ThreadedCLIConnection
     from entrance.connection.netconf import ThreadedNCConnection
+    from entrance.connection.threaded import ConnectionError
 except ImportError:
     # Very cheesy way to permit the majority case (router interaction
     # features not required) to install the entrance package without
@@ -34,6 +35,8 @@ except ImportError:
 __all__ = ["SSHConnectionFactory"]
 
 BUF_SIZE = 10000  # ssh max buffer size
+RESYNC_QUIET = 0.5  # seconds without output before a resync is done
+RESYNC_TIMEOUT = 10  # seconds allowed to resync, before reconnecting
 
 
 class SSHCLIConnection(ThreadedCLIConnection):
@@ -41,6 +44,14 @@ class SSHCLIConnection(ThreadedCLIConnection):
     SSH CLI Connection
     """
 
+    # Internal attributes:
+    #
+    # wakeup
+    #   Event set when the channel has data to read (or has closed), or the
+    #   current request has been cancelled
+    #
+    wakeup = None
+
     def _handle_connect(self, **creds):
         """
         Initiate a persistent ssh connection, in the paramiko thread.
@@ -69,6 +80,8 @@ class SSHCLIConnection(ThreadedCLIConnection):
             time.sleep(1)
 
         # Should be sane now!
+        self.wakeup = threading.Event()
+        self.channel.in_buffer.set_event(self.wakeup)
         self._update_state(ConState.FINALIZING)
 
     def _handle_settimeout(self, timeout):
@@ -98,6 +111,8 @@ class SSHCLIConnection(ThreadedCLIConnection):
         """
         Wait for some data
         """
+        if not self._wait_readable():
+            return bytes()
         try:
             if nbytes > 0:
                 buf = self.channel.recv(nbytes)
@@ -109,6 +124,58 @@ class SSHCLIConnection(ThreadedCLIConnection):
         except socket.timeout:
             return bytes()
 
+    def _wait_readable(self):
+        """
+        Wait for data to read (or the channel to close), returning False
+        instead if the current request is cancelled or the timeout expires
+        """
+        # Clear the event before checking everything that might set it, so
+        # nothing gets missed
+        self.wakeup.clear()
+        if self.current_request.cancelled():
+            return False
+        channel = self.channel
+        if channel.recv_ready() or channel.closed or channel.eof_received:
+            return True
+        return (
+            self.wakeup.wait(channel.gettimeout())
+            and not self.current_request.cancelled()
+        )
+
+    def _interrupt(self):
+        """
+        Stop any wait for data for a cancelled request
+        """
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _resync(self):
+        """
+        Abandon any command still running after a cancelled request (with a
+        Ctrl-C), and discard any output up to the next prompt
+        """
+        self._log.debug("%s resyncing after cancelled request", self.name)
+        timeout = self.channel.gettimeout()
+        self.channel.settimeout(RESYNC_QUIET)
+        try:
+            self.channel.send("\x03")
+            buf = bytes()
+            deadline = time.monotonic() + RESYNC_TIMEOUT
+            while time.monotonic() < deadline:
+                try:
+                    data = self.channel.recv(BUF_SIZE)
+                except socket.timeout:
+                    # Gone quiet, so done if that's at a prompt
+                    if self._match_prompt(buf, False) is not None:
+                        return
+                    continue
+                if not data:
+                    raise ConnectionError("Connection closed during resync")
+                buf += data
+            raise ConnectionError("No prompt after cancelled request")
+        finally:
+            self.channel.settimeout(timeout)
+
 
 class SSHNCConnection(ThreadedNCConnection):
     """
@@ -128,6 +195,8 @@ class SSHNCConnection(ThreadedNCConnection):
             kwargs["key_filename"] = creds["ssh_key"]
         else:
             kwargs["password"] = creds.get("password", "")
+        # New session, so we know nothing about the candidate datastore
+        self._candidate_clean = False
         try:
             self.mgr = nc_mgr.connect_ssh(creds["host"], **kwargs)
             self.mgr.raise_mode = RaiseMode.NONE
@@ -3,11 +3,12 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import logging, re, threading
-import asyncio, janus
+import logging, queue, re, threading, time
+import asyncio
 
 from .base import Connection, ConState
-from .._util import events
+from .. import metrics
+from .._util import events, tracing
 
 log = logging.getLogger(__name__)
 
@@ -23,13 +24,30 @@ class ThreadedConnection(Connection):
     from the regular asyncio API as per all other Connection types
     """
 
+    # Internal attributes:
+    #
+    # current_request
+    #   Future for the request that the worker thread is carrying out (which
+    #   may be cancelled at any time, see _interrupt)
+    #
+    # resync_needed
+    #   Set in the event loop when a request is cancelled, and cleared by the
+    #   worker thread when it does a _resync
+    #
+    current_request = None
+    resync_needed = False
+
     def __init__(self, factory, name, finalizer=None):
         """
         Create a session object
         """
         super().__init__(factory, name, finalizer)
-        self.request_q = janus.Queue()
-        self.result_q = janus.Queue()
+        # Requests for the worker thread to block on, and results (plus
+        # connection state updates) from it, handed over to the event loop
+        # via call_soon_threadsafe
+        self.loop = asyncio.get_event_loop()
+        self.request_q = queue.SimpleQueue()
+        self.result_q = asyncio.Queue()
         self.thread = None
         self.event_loop_task = None
 
@@ -64,10 +82,13 @@ class ThreadedConnection(Connection):
         # Permanently wait for any responses to requests that are provided
         # by the worker thread, and dispatch the responses back appropriately
         while True:
+            result, fut = await self.result_q.get()
             try:
-                result, fut = await self.result_q.async_q.get()
                 if isinstance(result, ConState):
                     await self._set_state(result)
+                elif fut.cancelled():
+                    # Nobody is waiting for the result any more
+                    pass
                 elif isinstance(result, Exception):
                     fut.set_exception(result)
                 else:
@@ -85,6 +106,38 @@ class ThreadedConnection(Connection):
         """
         Queue a request to the worker thread
         """
+        self._check_request(action, override, args)
+        # If tracing, the worker thread records when it starts and finishes
+        # the request
+        trace = tracing.current.get()
+        timing = tracing.WorkerTiming() if trace is not None else None
+        start = time.perf_counter()
+        fut = asyncio.Future()
+        self.request_q.put((action, args, fut, timing))
+        try:
+            await asyncio.wait([fut], return_when=asyncio.ALL_COMPLETED)
+        except asyncio.CancelledError:
+            # Whoever wanted the result has given up on it (eg the request
+            # it's for was cancelled, or its deadline passed), so the worker
+            # thread can too
+            fut.cancel()
+            self.resync_needed = True
+            self._interrupt()
+            raise
+        end = time.perf_counter()
+        metrics.connection_request_latency.observe(
+            (type(self).__name__, action), end - start
+        )
+        if timing is not None and timing.finished is not None:
+            trace.add(action + " queue", timing.queued, timing.started)
+            trace.add(action + " device", timing.started, timing.finished)
+            trace.add(action + " wakeup", timing.finished, end)
+        return fut.result()
+
+    def _check_request(self, action, override, args):
+        """
+        Raise ConnectionError if a request can't be made in the current state
+        """
         # The override flag is intended for two purposes:
         #
         # - forcing a manual disconnect from any state
@@ -100,10 +153,25 @@ class ThreadedConnection(Connection):
                     self.name, self.state.name, action, args
                 )
             )
-        fut = asyncio.Future()
-        await self.request_q.async_q.put((action, args, fut))
-        await asyncio.wait([fut], return_when=asyncio.ALL_COMPLETED)
-        return fut.result()
+
+    def _interrupt(self):
+        """
+        Called in the event loop after cancelling the future for a request, to
+        make the worker thread stop waiting (eg for data from the router) if
+        it's in the middle of it. Subclasses that can do so should override
+        this; by default, the request just runs to completion, and its result
+        is ignored.
+        """
+        pass
+
+    def _resync(self):
+        """
+        Called in the worker thread before carrying out a request, if any
+        earlier ones were cancelled, to get the session back into a known
+        state (eg by abandoning a command still running). Nothing to do by
+        default.
+        """
+        pass
 
     def _update_state(self, state, failure_reason=None):
         """
@@ -111,7 +179,17 @@ class ThreadedConnection(Connection):
         """
         if failure_reason is not None:
             state.failure_reason = failure_reason
-        self.result_q.sync_q.put((state, None))
+        self._put_result((state, None))
+
+    def _put_result(self, item):
+        """
+        Pass a (result, future) pair back to the event loop
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.result_q.put_nowait, item)
+        except RuntimeError:
+            # Event loop closed, so there's nobody to tell
+            pass
 
     def _thread_main(self, **kwargs):
         """
@@ -142,15 +220,22 @@ class ThreadedConnection(Connection):
                     )
                 initiate_connect = False
 
-            # Block for a request
-            action, args, fut = self.request_q.sync_q.get()
+            # Block for a request, skipping it if it's already been cancelled
+            action, args, fut, timing = self.request_q.get()
+            if fut.cancelled():
+                continue
             if not (action == "recv" and len(args) == 1 and args[0] == 0):
                 log.debug("{} worker thread req: {}{}".format(self.name, action, args))
 
             # Do the request
-            handler = getattr(self, "_handle_" + action)
+            if timing is not None:
+                timing.started = time.perf_counter()
             try:
-                result = handler(*args)
+                if self.resync_needed and action != "disconnect":
+                    self.resync_needed = False
+                    self._resync()
+                self.current_request = fut
+                result = self._do_request(action, args)
             except Exception as e:
                 # Err on the side of caution for customer demo purposes -
                 # ditch the whole thing lazily (leaking all sorts of stuff) and
@@ -169,6 +254,15 @@ class ThreadedConnection(Connection):
                 result = e
 
             # Return the result
-            self.result_q.sync_q.put((result, fut))
+            if timing is not None:
+                timing.finished = time.perf_counter()
+            self._put_result((result, fut))
 
         log.debug("%s thread main exit", self.name)
+
+    def _do_request(self, action, args):
+        """
+        Carry out a request in the worker thread, by calling the corresponding
+        _handle_<action> method
+        """
+        return getattr(self, "_handle_" + action)(*args)
@@ -1,19 +1,31 @@
-# Feature base class
-from .base import Feature
+# Feature base class, and registry of all features by name
+from .base import Feature, feature_by_name
 
-# Configured features
+# Configured base class
 from .cfg_base import ConfiguredFeature
-from .cfg_core import CoreFeature
-from .cfg_persist import PersistFeature
 
 # Dynamic base class
 from .dyn_base import DynamicFeature
 
-# Target features
+# Target features base classes
 from .tgt_base import TargetFeature
 from .tgt_group import TargetGroupFeature
 
-from .tgt_cli_config import CLIConfigFeature
-from .tgt_cli_exec import CLIExecFeature
-from .tgt_netconf import NetconfFeature
-from .tgt_syslog import SyslogFeature
+# Concrete features are imported on first use, via feature_by_name
+_lazy_features = {
+    "CoreFeature": "core",
+    "PersistFeature": "persist",
+    "CLIConfigFeature": "cli_config",
+    "CLIExecFeature": "cli_exec",
+    "NetconfFeature": "netconf",
+    "SyslogFeature": "syslog",
+}
+
+
+def __getattr__(name):
+    """
+    Import concrete feature classes on demand
+    """
+    if name in _lazy_features:
+        return feature_by_name[_lazy_features[name]]
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
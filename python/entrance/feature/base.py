@@ -2,9 +2,12 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import logging
+import asyncio, logging, sys, time
 
+from .. import metrics
 from ..exceptions import EntranceError
+from .._util import profiling, tracing
+from .._util.registry import LazyRegistry
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +28,9 @@ class Feature:
     # Notifications that a subclass sends. None can be used as an RPC reply
     notifications = [None]
 
+    # Computed for each subclass: req_type -> (handler, arg_specs)
+    dispatch = {}
+
     def __init__(self, ws_handler):
         self.ws_handler = ws_handler
 
@@ -34,49 +40,64 @@ class Feature:
         """
         pass
 
-    @classmethod
-    def normalize_schema(feature_cls):
-        """
-        Ensure that each Feature subclass's schema includes any requests and
-        notifications from its parent classes. In addition, add 'None' as a
-        permissible notification type, since this is used for RPC replies, and
-        automatically permit each req_type as a nfn_type (for use in replies)
-        """
-
-        def normalize_cls(current_cls, parent_cls):
-            current_cls.requests = {**current_cls.requests, **parent_cls.requests}
-            current_cls.notifications = frozenset(
-                set(current_cls.notifications)
-                | set(parent_cls.notifications)
-                | current_cls.requests.keys()
+    def __init_subclass__(cls, **kwargs):
+        """
+        Precompute each new subclass's schema and dispatch table, and index it
+        by name. The schema includes any requests and notifications from its
+        parent classes. In addition, 'None' is a permissible notification
+        type, since this is used for RPC replies, and each req_type is
+        automatically permitted as a nfn_type (for use in replies)
+        """
+        super().__init_subclass__(**kwargs)
+        requests = {}
+        notifications = set()
+        for base in reversed(cls.__mro__[1:]):
+            if issubclass(base, Feature):
+                requests.update(base.requests)
+                notifications.update(base.notifications)
+        requests.update(cls.__dict__.get("requests", {}))
+        notifications.update(cls.__dict__.get("notifications", ()))
+        cls.requests = requests
+        cls.notifications = frozenset(notifications | requests.keys())
+
+        # For each req_type, the handler method and how to extract each of its
+        # arguments from the request. A magic argument name of '__req__' means
+        # supply the entire request, and an argument name starting with '?' is
+        # optional (value None if unspecified). The names are interned, since
+        # they are shared by every feature class with the same requests.
+        cls.dispatch = {
+            sys.intern(req_type): (
+                getattr(cls, "do_" + req_type, None),
+                tuple(
+                    (None, False)
+                    if arg == "__req__"
+                    else (sys.intern(arg[1:]), True)
+                    if arg.startswith("?")
+                    else (sys.intern(arg), False)
+                    for arg in arg_names
+                ),
             )
-            for child_cls in current_cls.__subclasses__():
-                normalize_cls(child_cls, current_cls)
+            for req_type, arg_names in requests.items()
+        }
 
-        for cls in feature_cls.__subclasses__():
-            normalize_cls(cls, feature_cls)
+        if "name" in cls.__dict__ and cls.name is not None:
+            feature_by_name[cls.name] = cls
 
     async def handle(self, req):
         """
-        Handle incoming websocket requests
+        Handle incoming websocket requests. A request can have a "deadline":
+        the number of seconds it is allowed, after which it is cancelled (and
+        gets a failure reply).
         """
         try:
-            # Extract out the request type and the arguments it wants. A magic
-            # argument name of '__req__' means supply the entire request, and
-            # and argument name starting with '?' is optional (value None if
-            # unspecified)
+            # Extract out the request type and the arguments it wants (see
+            # __init_subclass__ for the arg_specs)
             req_type = req["req_type"]
-            arg_names = self.requests[req_type]
-
-            def get_arg(arg):
-                if arg == "__req__":
-                    return req
-                elif arg.startswith("?"):
-                    return req.get(arg[1:], None)
-                else:
-                    return req[arg]
-
-            args = [get_arg(arg) for arg in arg_names]
+            handler, arg_specs = self.dispatch[req_type]
+            args = [
+                req if arg is None else req.get(arg) if optional else req[arg]
+                for arg, optional in arg_specs
+            ]
         except KeyError:
             # Couldn't extract the request type and arguments as per the
             # supplied schema. Can't proceed.
@@ -89,8 +110,33 @@ class Feature:
             return
 
         # Do the operation
+        labels = (self.name, req_type)
+        metrics.requests_in_flight.inc(labels)
+        profiler = profiling.request_profiler
+        profile = profiler.profile(req_type) if profiler is not None else None
+        start = time.perf_counter()
+        trace = tracing.current.get()
+        if trace is not None:
+            trace.add("dispatch", trace.start, start)
+        deadline = req.get("deadline")
+        cancelled = False
         try:
-            result = await getattr(self, "do_" + req_type)(*args)
+            if deadline is None:
+                result = await handler(self, *args)
+            else:
+                try:
+                    result = await asyncio.wait_for(handler(self, *args), deadline)
+                except asyncio.TimeoutError:
+                    log.info("%s exceeded its deadline of %ss", req_type, deadline)
+                    result = self._rpc_failure(
+                        "{} exceeded its deadline of {}s".format(req_type, deadline)
+                    )
+        except asyncio.CancelledError:
+            # Eg by a cancel request (see CoreFeature.do_cancel). Still send a
+            # failure reply, before finishing being cancelled.
+            log.info("%s request cancelled", req_type)
+            cancelled = True
+            result = self._rpc_failure("{} cancelled".format(req_type))
         except Exception as e:
             msg = "Exception handling {}({})".format(
                 req_type, ", ".join(str(arg) for arg in args)
@@ -98,6 +144,14 @@ class Feature:
             log.error(msg + " (see debug.log for details)")
             log.debug("Exception details", exc_info=True, stack_info=True)
             result = self._rpc_failure(msg)
+        finally:
+            if profile is not None:
+                profiler.finish(profile)
+            end = time.perf_counter()
+            metrics.request_latency.observe(labels, end - start)
+            metrics.requests_in_flight.dec(labels)
+            if trace is not None:
+                trace.add("handler", start, end)
 
         # Return a notification with the result if provided
         if result is not None:
@@ -111,7 +165,14 @@ class Feature:
                 result["target"] = req["target"]
             if result.get("nfn_type", None) is None:
                 result["nfn_type"] = req_type
-            await self.ws_handler.notify(**result)
+            if trace is not None and req.get("trace"):
+                result["trace"] = trace.summary()
+            with tracing.span("reply"):
+                await self.ws_handler.notify(**result)
+        if trace is not None:
+            trace.finish()
+        if cancelled:
+            raise asyncio.CancelledError()
 
     def _check_nfn_type(self, nfn_type):
         """
@@ -155,3 +216,22 @@ class Feature:
         """
         # nfn_type of None means use the original req_type
         return self._result(nfn_type=None, error=error, **kwargs)
+
+
+# Map of feature names to classes. The built-in features are only imported
+# when first used, and further features can be provided by other packages via
+# "entrance.features" entry points. Every subclass with its own name adds
+# itself when defined (including those defined by apps), so lookups never
+# need to search the class hierarchy.
+feature_by_name = LazyRegistry(
+    "entrance.features",
+    {
+        "core": "entrance.feature.cfg_core:CoreFeature",
+        "persist": "entrance.feature.cfg_persist:PersistFeature",
+        "target_group": "entrance.feature.tgt_group:TargetGroupFeature",
+        "cli_config": "entrance.feature.tgt_cli_config:CLIConfigFeature",
+        "cli_exec": "entrance.feature.tgt_cli_exec:CLIExecFeature",
+        "netconf": "entrance.feature.tgt_netconf:NetconfFeature",
+        "syslog": "entrance.feature.tgt_syslog:SyslogFeature",
+    },
+)
@@ -20,9 +20,16 @@ class ConfiguredFeature(Feature):
 
     def __init__(self, ws_handler, config):
         """
-        Merge in any specifed configuration with our defaults
+        Merge in any specifed configuration with (a copy of) our defaults. The
+        result is shared by all the sessions with the same configuration, so
+        must be treated as read-only.
         """
         super().__init__(ws_handler)
+        merged = self.__class__.__dict__.get("_merged_config")
+        if merged is not None and merged[0] is config:
+            self.config = merged[1]
+            return
+        self.config = dict(self.config)
         for key, val in config.items():
             if key in self.config:
                 self.config[key] = val
@@ -36,6 +43,8 @@ class ConfiguredFeature(Feature):
                     "\n!! ".join(msg_parts)
                 )
                 raise EntranceError(". ".join(msg_parts))
+        # Remember the result for the next session (until reconfigured)
+        self.__class__._merged_config = (config, self.config)
 
     @classmethod
     def all(cls):
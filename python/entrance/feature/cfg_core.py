@@ -2,7 +2,10 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import logging, os
+import asyncio, base64, logging, os, time
+from .. import live_config
+from ..exceptions import EntranceError
+from .._util import profiling
 from .cfg_base import ConfiguredFeature
 from .dyn_base import DynamicFeature
 from .tgt_base import TargetFeature
@@ -21,15 +24,28 @@ class CoreFeature(ConfiguredFeature):
     name = "core"
 
     requests = {
-        "force_restart": [],
+        "cancel": ["cancel_id"],
+        "force_restart": ["?mode"],
         "ping": [],
+        "profile_collect": [],
+        "profile_requests": ["request_type", "?count"],
+        "profile_start": ["?seconds", "?interval"],
+        "profile_stop": [],
+        "reload_config": [],
         "start_feature": ["feature", "channel", "target", "__req__"],
         "stop_feature": ["feature", "channel", "target"],
     }
 
     notifications = ["pong"]
 
-    config = {"allow_restart_requests": False, "allowed_dynamic_features": None}
+    # Profiling requests are refused unless allow_profiling is set, in which
+    # case results are also saved in profile_dir
+    config = {
+        "allow_restart_requests": False,
+        "allowed_dynamic_features": None,
+        "allow_profiling": False,
+        "profile_dir": "profiles",
+    }
 
     #
     # Implementation
@@ -38,14 +54,48 @@ class CoreFeature(ConfiguredFeature):
         super().__init__(ws_handler, config)
         self.started_features = {}
 
-    async def do_force_restart(self):
+    async def do_cancel(self, cancel_id):
+        """
+        Cancel the request with the given id, if it's still in progress (and
+        handled asynchronously, ie by a dynamic feature). The cancelled
+        request gets a failure reply.
+        """
+        if not self.ws_handler.cancel_request(cancel_id):
+            return self._rpc_failure("No request {} in progress".format(cancel_id))
+        return self._rpc_success("")
+
+    async def do_force_restart(self, mode=None):
         """
-        Forcibly restart the server (assuming started by the "run" script)
+        Forcibly restart the server (assuming started by the "run" script).
+        Alternatively, if mode is "handoff", then start a fresh server process
+        (eg after an upgrade) that takes over new websockets, while existing
+        ones are moved across gradually (see server.create_app).
         """
-        if self.config["allow_restart_requests"]:
+        if not self.config["allow_restart_requests"]:
+            return self._rpc_failure("Restart disallowed by configuration")
+        if mode == "handoff":
+            try:
+                _current_live_config().handoff()
+            except EntranceError as e:
+                return self._rpc_failure("Hand-off failed: {}".format(e))
+            return self._rpc_success("")
+        elif mode is None:
             os._exit(42)
         else:
-            return self._rpc_failure("Restart disallowed by configuration")
+            return self._rpc_failure("Unknown restart mode {}".format(mode))
+
+    async def do_reload_config(self):
+        """
+        Reload the features config from the config file, for new websockets.
+        This websocket (and any others already open) keep their config.
+        """
+        if not self.config["allow_restart_requests"]:
+            return self._rpc_failure("Reload disallowed by configuration")
+        try:
+            _current_live_config().reload()
+        except EntranceError as e:
+            return self._rpc_failure("Reload failed: {}".format(e))
+        return self._rpc_success("")
 
     async def do_ping(self):
         """
@@ -53,6 +103,83 @@ class CoreFeature(ConfiguredFeature):
         """
         return self._result("pong")
 
+    async def do_profile_start(self, seconds=None, interval=None):
+        """
+        Start the sampling profiler, for some number of seconds (default 30)
+        """
+        global _sampler
+        if not self.config["allow_profiling"]:
+            return self._rpc_failure("Profiling disallowed by configuration")
+        if _sampler is not None and _sampler.thread.is_alive():
+            return self._rpc_failure("Sampling profiler already running")
+        _sampler = profiling.SamplingProfiler(seconds or 30, interval or 0.005)
+        _sampler.start()
+        return self._rpc_success("")
+
+    async def do_profile_stop(self):
+        """
+        Stop the sampling profiler (if it hasn't already stopped by itself),
+        and reply with the collapsed stacks
+        """
+        global _sampler
+        if not self.config["allow_profiling"]:
+            return self._rpc_failure("Profiling disallowed by configuration")
+        sampler, _sampler = _sampler, None
+        if sampler is None:
+            return self._rpc_failure("Sampling profiler not started")
+        await asyncio.get_event_loop().run_in_executor(None, sampler.stop)
+        collapsed = sampler.collapsed()
+        filename = self._save_profile("samples", "txt", collapsed.encode())
+        return self._rpc_success(collapsed, filename=filename, samples=sampler.samples)
+
+    async def do_profile_requests(self, req_type, count=None):
+        """
+        Run cProfile around the handling of the next count (default 1)
+        requests of the given req_type (the request_type argument), for later
+        profile_collect
+        """
+        if not self.config["allow_profiling"]:
+            return self._rpc_failure("Profiling disallowed by configuration")
+        if profiling.request_profiler is None:
+            profiling.request_profiler = profiling.RequestProfiler()
+        profiling.request_profiler.arm(req_type, count or 1)
+        return self._rpc_success("")
+
+    async def do_profile_collect(self):
+        """
+        Reply with the stats from profile_requests (a text summary, and the
+        base64-encoded pstats file), and turn request profiling off again
+        """
+        if not self.config["allow_profiling"]:
+            return self._rpc_failure("Profiling disallowed by configuration")
+        profiler, profiling.request_profiler = profiling.request_profiler, None
+        if profiler is None:
+            return self._rpc_failure("Request profiling not enabled")
+        profiled = profiler.profiled
+        data, summary = profiler.collect()
+        if data is None:
+            return self._rpc_failure("No requests profiled yet")
+        filename = self._save_profile("requests", "pstats", data)
+        return self._rpc_success(
+            summary,
+            filename=filename,
+            profiled=profiled,
+            pstats=base64.b64encode(data).decode(),
+        )
+
+    def _save_profile(self, kind, extension, data):
+        """
+        Save profiling results in profile_dir, returning the filename
+        """
+        os.makedirs(self.config["profile_dir"], exist_ok=True)
+        filename = os.path.join(
+            self.config["profile_dir"],
+            "{}-{}.{}".format(kind, time.strftime("%Y%m%d-%H%M%S"), extension),
+        )
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
     async def do_start_feature(self, feature_name, channel, target, req):
         """
         Start an optional feature
@@ -89,6 +216,17 @@ class CoreFeature(ConfiguredFeature):
             await feature.disconnect()
 
 
+# The running sampling profiler, if any
+_sampler = None
+
+
+def _current_live_config():
+    """Get the server's LiveConfig, if it has one"""
+    if live_config.current is None:
+        raise EntranceError("Server has no live config")
+    return live_config.current
+
+
 def _fk(feature_name, channel, target):
     """Construct a dict key for a feature instance"""
     return "{}::{}::{}".format(feature_name, channel, target)
@@ -3,22 +3,36 @@
 # Copyright (c) 2018 Ensoft Ltd
 
 from collections import defaultdict
-import ujson
+from contextlib import asynccontextmanager
+import asyncio, os
 from .cfg_base import ConfiguredFeature
+from .persist_store import store_by_name
 
 # Remember which active websockets have requested data for a given channel, so
 # that any changes can get published to everyone.
 # userid name -> channel name -> set of interested PersistFeature instances
 listeners = defaultdict(lambda: defaultdict(set))
 
+# Lock per (userid, channel) that is being saved or loaded, with a count of
+# the requests using it, so that concurrent saves to a channel don't
+# interleave their reads, writes and patches, and a load never misses a save.
+# (userid, channel) -> (lock, users)
+channel_locks = {}
+
+# One store per backend and database filename, shared by all PersistFeature
+# instances
+stores = {}
+
 
 class PersistFeature(ConfiguredFeature):
     """
     Feature that saves and retrieves arbitrary data chunks for the frontend app.
-    Intended for small bits of data (eg preferences) - load/save operations
-    are not expected to be efficient. This assumes it is called only from
-    one thread (the main event loop thread). Each channel (for each userid)
-    can save or load one JSONable value.
+    The storage backend is pluggable (see persist_store.PersistStore): by
+    default the whole database is held in memory, and saves are written behind
+    by a background thread (JournalStore); alternatively SQLite scales to
+    large numbers of channels (SQLiteStore). This assumes it is called only
+    from one thread (the main event loop thread). Each channel (for each
+    userid) can save or load one JSONable value.
     """
 
     #
@@ -29,16 +43,54 @@ class PersistFeature(ConfiguredFeature):
     requests = {
         "persist_save_async": ["userid", "channel", "data"],
         "persist_save_sync": ["userid", "channel", "data"],
-        "persist_load": ["userid", "channel", "default"],
+        "persist_load": ["userid", "channel", "default", "?delta"],
+        "persist_load_range": ["userid", "channel", "?offset", "?length"],
+        "persist_load_page": ["userid", "channel", "page", "?page_size"],
     }
 
-    config = {"filename": "persist.json"}
+    notifications = ["persist_patch"]
+
+    # backend is a key in persist_store.store_by_name. fsync is one of
+    # "always" (every write), "interval" (at most every fsync_interval
+    # seconds) or "never" (leave it to the OS). The journal backend's journal
+    # is compacted into the main file once it exceeds compact_bytes, and it
+    # keeps list or string values bigger than side_file_bytes (0 to disable)
+    # in memory-mapped side files. page_size is the default for
+    # persist_load_page.
+    config = {
+        "backend": "journal",
+        "filename": "persist.json",
+        "fsync": "interval",
+        "fsync_interval": 1.0,
+        "compact_bytes": 1000000,
+        "side_file_bytes": 1000000,
+        "page_size": 100,
+    }
+
+    def __init__(self, ws_handler, config):
+        super().__init__(ws_handler, config)
+        key = (self.config["backend"], self.config["filename"])
+        if key not in stores:
+            stores[key] = store_by_name[self.config["backend"]](self.config)
+        self.store = stores[key]
+
+        # Reverse index of our entries in listeners, as (userid, channel)
+        # pairs, and the subset of those that want persist_patch deltas
+        # rather than the whole value on each change
+        self.subscriptions = set()
+        self.delta_subscriptions = set()
 
     # Unsubscribe ourselves from everything on close
     def close(self):
-        for userid in listeners.values():
-            for channels in userid.values():
-                channels.remove(self)
+        for userid, channel in self.subscriptions:
+            channels = listeners[userid]
+            channels[channel].discard(self)
+            if not channels[channel]:
+                del channels[channel]
+                if not channels:
+                    del listeners[userid]
+        self.subscriptions = set()
+        self.delta_subscriptions = set()
 
     #
     # Implementation
@@ -47,57 +99,228 @@ class PersistFeature(ConfiguredFeature):
         """
         Save a table, overwriting it if already present
         """
-        db = self._load_db()
-        if userid not in db:
-            db[userid] = {channel: data}
-        else:
-            db[userid][channel] = data
-        self._save_db(db)
-
-        # Notify any other peer connections that care about this
-        for obj in listeners[userid][channel]:
-            if obj != self:
-                await obj._notify(nfn_type="persist_load", channel=channel, data=data)
+        await self._save(userid, channel, data, wait=False)
 
     async def do_persist_save_sync(self, userid, channel, data):
         """
-        Same as do_persist_save, with a synchronous reply.
+        Same as do_persist_save, with a synchronous reply once the data has
+        been written out.
         """
         try:
-            await self.do_persist_save_async(userid, channel, data)
+            await self._save(userid, channel, data, wait=True)
             return self._rpc_success("")
         except Exception as e:
-            return self._rpc_failure(e)
+            return self._rpc_failure(str(e))
 
-    async def do_persist_load(self, userid, channel, default):
+    async def do_persist_load(self, userid, channel, default, delta=False):
+        """
+        Load a table. If not present then return the specified default. If
+        delta is set, then subsequent changes are sent as persist_patch
+        notifications, rather than persist_load with the whole value.
         """
-        Load a table. If not present then return the specified default
+        # Subscribe and load under the channel's lock, so that we either
+        # see a concurrent save's data or get notified of it
+        async with _channel_lock(userid, channel):
+            listeners[userid][channel].add(self)
+            self.subscriptions.add((userid, channel))
+            if delta:
+                self.delta_subscriptions.add((userid, channel))
+            else:
+                self.delta_subscriptions.discard((userid, channel))
+
+            try:
+                data = await self.store.get(userid, channel)
+            except KeyError:
+                data = default
+        return self._result("persist_load", data=data)
+
+    async def do_persist_load_range(self, userid, channel, offset=None, length=None):
         """
-        listeners[userid][channel].add(self)  # subscribe
-        db = self._load_db()
+        Load part of a list (or string) table: up to length items (or
+        characters) from offset, or to the end if no length. The reply also
+        has the total length. Unlike persist_load, this doesn't subscribe to
+        changes.
+        """
+        offset = offset or 0
         try:
-            data = db[userid][channel]
+            data, total = await self.store.get_range(userid, channel, offset, length)
         except KeyError:
-            data = default
-        return self._result("persist_load", data=data)
+            return self._rpc_failure("No data for channel {}".format(channel))
+        except ValueError as e:
+            return self._rpc_failure(str(e))
+        return self._result(
+            "persist_load_range", data=data, offset=offset, total=total
+        )
 
-    def _load_db(self):
+    async def do_persist_load_page(self, userid, channel, page, page_size=None):
         """
-        Load the entire database
+        Load one page of a list (or string) table, counting pages from zero
         """
+        page_size = page_size or self.config["page_size"]
+        if page < 0 or page_size < 0:
+            return self._rpc_failure("Page and page size must not be negative")
         try:
-            # tsk - synchronous file I/O. ho hum.
-            with open(self.config["filename"]) as f:
-                return ujson.loads(f.read())
-        except FileNotFoundError:
-            return {}
+            data, total = await self.store.get_range(
+                userid, channel, page * page_size, page_size
+            )
+        except KeyError:
+            return self._rpc_failure("No data for channel {}".format(channel))
         except ValueError as e:
-            raise Exception("{} is invalid json: {}".format(self.config["filename"], e))
+            return self._rpc_failure(str(e))
+        return self._result(
+            "persist_load_page",
+            data=data,
+            page=page,
+            page_size=page_size,
+            pages=(total + page_size - 1) // page_size,
+            total=total,
+        )
+
+    async def _save(self, userid, channel, data, wait):
+        """
+        Save a table, and notify any other peer connections that care about it
+        """
+        async with _channel_lock(userid, channel):
+            await self._save_locked(userid, channel, data, wait)
 
-    def _save_db(self, db):
+    async def _save_locked(self, userid, channel, data, wait):
         """
-        Save the entire database
+        Save a table holding its channel lock, so that any patch is relative to
+        the value that the previous save's listeners were sent
         """
-        # tsk - synchronous file I/O again. la di da.
-        with open(self.config["filename"], "w") as f:
-            f.write(ujson.dumps(db, indent=4))
+        others = [obj for obj in listeners[userid][channel] if obj is not self]
+        want_delta = [
+            obj for obj in others if (userid, channel) in obj.delta_subscriptions
+        ]
+
+        # Work out a patch just once, and only if anyone wants it
+        patch = None
+        if want_delta:
+            try:
+                old_data = await self.store.get(userid, channel)
+                patch = json_diff(old_data, data)
+            except KeyError:
+                pass
+
+        await self.store.set(userid, channel, data, wait=wait)
+
+        for obj in others:
+            if patch is not None and obj in want_delta:
+                await obj._notify(nfn_type="persist_patch", channel=channel, patch=patch)
+            else:
+                await obj._notify(nfn_type="persist_load", channel=channel, data=data)
+
+
+@asynccontextmanager
+async def _channel_lock(userid, channel):
+    """
+    Hold the lock for a (userid, channel), creating it if need be, and
+    dropping it once nobody is using it
+    """
+    key = (userid, channel)
+    lock, users = channel_locks.get(key, (None, 0))
+    if lock is None:
+        lock = asyncio.Lock()
+    channel_locks[key] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = channel_locks[key]
+        if users == 1:
+            del channel_locks[key]
+        else:
+            channel_locks[key] = (lock, users - 1)
+
+
+def json_diff(old, new, path=""):
+    """
+    Return a list of JSON-patch (RFC 6902) style operations that turn old into
+    new. Dicts are compared key by key, lists after trimming any common prefix
+    and suffix, and strings are patched with a non-standard "splice" operation
+    (replace "remove" characters at "offset" with "insert"), so that changing
+    one line of a big text value yields a small patch. Splice offsets and
+    lengths count UTF-16 code units, as JavaScript strings do.
+    """
+    if _json_equal(old, new):
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _json_path(path, key)})
+        for key, value in new.items():
+            if key in old:
+                ops.extend(json_diff(old[key], value, _json_path(path, key)))
+            else:
+                ops.append({"op": "add", "path": _json_path(path, key), "value": value})
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        shortest = min(len(old), len(new))
+        start = 0
+        while start < shortest and _json_equal(old[start], new[start]):
+            start += 1
+        end = 0
+        while end < shortest - start and _json_equal(old[-1 - end], new[-1 - end]):
+            end += 1
+        old_mid = old[start : len(old) - end]
+        new_mid = new[start : len(new) - end]
+        common = min(len(old_mid), len(new_mid))
+        ops = []
+        for i in range(common):
+            ops.extend(json_diff(old_mid[i], new_mid[i], _json_path(path, start + i)))
+        for i in reversed(range(common, len(old_mid))):
+            ops.append({"op": "remove", "path": _json_path(path, start + i)})
+        for i in range(common, len(new_mid)):
+            ops.append(
+                {"op": "add", "path": _json_path(path, start + i), "value": new_mid[i]}
+            )
+        return ops
+
+    if isinstance(old, str) and isinstance(new, str):
+        prefix = len(os.path.commonprefix([old, new]))
+        suffix = len(os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]]))
+        return [
+            {
+                "op": "splice",
+                "path": path,
+                "offset": _utf16_len(old[:prefix]),
+                "remove": _utf16_len(old[prefix : len(old) - suffix]),
+                "insert": new[prefix : len(new) - suffix],
+            }
+        ]
+
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _json_equal(old, new):
+    """
+    Compare two JSON values, treating different types as unequal all the way
+    down (unlike ==, for which 1 == 1.0 == True)
+    """
+    if type(old) != type(new):
+        return False
+    if isinstance(old, dict):
+        return old.keys() == new.keys() and all(
+            _json_equal(value, new[key]) for key, value in old.items()
+        )
+    if isinstance(old, list):
+        return len(old) == len(new) and all(map(_json_equal, old, new))
+    return old == new
+
+
+def _utf16_len(text):
+    """
+    Length of a string in UTF-16 code units (so counting characters outside
+    the Basic Multilingual Plane, eg most emoji, twice)
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _json_path(path, key):
+    """
+    Extend a JSON pointer (RFC 6901) with a dict key or list index
+    """
+    return "{}/{}".format(path, str(key).replace("~", "~0").replace("/", "~1"))
@@ -2,7 +2,7 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-from .base import Feature
+from .base import Feature, feature_by_name
 
 
 class DynamicFeature(Feature):
@@ -35,18 +35,9 @@ class DynamicFeature(Feature):
     @classmethod
     def find(cls, name):
         """
-        Look up a concrete subclass by "name" field
+        Look up a concrete subclass by "name" field (in the index of all
+        features, see Feature.__init_subclass__)
         """
-        return _find(cls, name)
-
-
-def _find(cls, name):
-    """
-    Recursively find the named subclass
-    """
-    for c in cls.__subclasses__():
-        if c.name == name:
-            return c
-        v = _find(c, name)
-        if v is not None:
-            return v
+        feature_cls = feature_by_name.get(name)
+        if feature_cls is not None and issubclass(feature_cls, cls):
+            return feature_cls
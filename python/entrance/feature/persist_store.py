@@ -0,0 +1,600 @@
+# Storage backends for the persistence feature
+#
+# Copyright (c) 2018 Ensoft Ltd
+
+import array, asyncio, atexit, concurrent.futures, logging, mmap, os, queue
+import re, sqlite3, threading, time, uuid
+import ujson
+
+log = logging.getLogger(__name__)
+
+
+class PersistStore:
+    """
+    Base class for a persist database backend, mapping a (userid, channel)
+    pair to a JSONable value. Methods are called only from the event loop
+    thread, and must not block it.
+    """
+
+    def __init__(self, config):
+        """
+        Backends pick out whichever PersistFeature config items they need
+        """
+        self.filename = config["filename"]
+        self.fsync = config["fsync"]
+
+    async def get(self, userid, channel):
+        """
+        Return the data for a userid and channel, or raise KeyError
+        """
+        raise NotImplementedError
+
+    async def set(self, userid, channel, data, wait=False):
+        """
+        Save the data for a userid and channel. If wait is set, then only
+        return once the change has been written out.
+        """
+        raise NotImplementedError
+
+    async def get_range(self, userid, channel, offset, length):
+        """
+        Return (part, total) where part is up to length items (or characters)
+        from offset of a list (or string) value, and total is the length of
+        the whole value. A length of None means to the end. Raises KeyError if
+        there is no value, or ValueError if it isn't a list or string, or the
+        offset or length is negative.
+
+        Backends can override this to avoid loading the whole value.
+        """
+        return _slice(await self.get(userid, channel), offset, length)
+
+    def close(self):
+        """
+        Write out everything outstanding and release any resources
+        """
+        pass
+
+
+class JournalStore(PersistStore):
+    """
+    Persist database held in memory, and loaded from disk just once. This is
+    the default backend.
+
+    On disk, there is a snapshot of the whole database (the configured
+    filename, in the same format as it has always been) plus an append-only
+    journal of subsequent changes (one JSON [userid, channel, data] line per
+    save). Saves update memory immediately, and are queued for a background
+    thread to append to the journal, so there is no file I/O on the event
+    loop. Once the journal grows past compact_bytes, the writer thread writes
+    a fresh snapshot to a temporary file, atomically replaces the old one, and
+    truncates the journal.
+
+    The writer thread keeps its own copy of the database's dict structure
+    (sharing the data values, which are never mutated once saved) so that it
+    can write snapshots without racing against the event loop.
+
+    List and string values whose JSON encoding is bigger than side_file_bytes
+    are moved out of memory by the writer thread, into a SideValue file in
+    the <filename>.values directory. The journal and snapshot then just refer
+    to that file, via a marker dict. So that a client can't save a value that
+    looks like a marker, any saved dict with the marker key (or the escape
+    key) is written wrapped up as {ESCAPED: value}, and unwrapped on load.
+    """
+
+    ESCAPED = "__persist_escaped__"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.journal_filename = self.filename + ".journal"
+        self.side_dir = self.filename + ".values"
+        self.fsync_interval = config["fsync_interval"]
+        self.compact_bytes = config["compact_bytes"]
+        self.side_file_bytes = config["side_file_bytes"]
+        self.db = self._load()
+        self.write_q = queue.Queue()
+        shadow = {userid: dict(channels) for userid, channels in self.db.items()}
+        self.thread = threading.Thread(
+            name="persist-writer",
+            daemon=True,
+            target=self._writer_main,
+            args=(shadow,),
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    async def get(self, userid, channel):
+        data = self.db[userid][channel]
+        if isinstance(data, SideValue):
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(None, data.load)
+        return data
+
+    async def get_range(self, userid, channel, offset, length):
+        data = self.db[userid][channel]
+        if isinstance(data, SideValue):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, data.range, offset, length)
+        return _slice(data, offset, length)
+
+    async def set(self, userid, channel, data, wait=False):
+        self.db.setdefault(userid, {})[channel] = data
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future() if wait else None
+        self.write_q.put((userid, channel, data, loop, fut))
+        if fut is not None:
+            await fut
+
+    def close(self):
+        if self.thread.is_alive():
+            self.write_q.put(None)
+            self.thread.join()
+
+    def _load(self):
+        """
+        Load the snapshot, and replay the journal on top
+        """
+        try:
+            with open(self.filename) as f:
+                db = ujson.loads(f.read())
+        except FileNotFoundError:
+            db = {}
+        except ValueError as e:
+            raise Exception("{} is invalid json: {}".format(self.filename, e))
+
+        try:
+            with open(self.journal_filename) as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        userid, channel, data = ujson.loads(line)
+                    except ValueError:
+                        # Most likely a partial write when we last died
+                        log.warning(
+                            "Ignoring invalid line %d of %s",
+                            lineno,
+                            self.journal_filename,
+                        )
+                        continue
+                    db.setdefault(userid, {})[channel] = data
+        except FileNotFoundError:
+            pass
+
+        # Values in side files are only opened on demand
+        for channels in db.values():
+            for channel, data in channels.items():
+                if not isinstance(data, dict):
+                    continue
+                if self.ESCAPED in data:
+                    channels[channel] = data[self.ESCAPED]
+                elif SideValue.MARKER in data:
+                    try:
+                        channels[channel] = SideValue.from_marker(self.side_dir, data)
+                    except ValueError as e:
+                        log.error("Ignoring side file for %s: %s", channel, e)
+        return db
+
+    def _escape(self, data):
+        """
+        Wrap up a value that could otherwise be mistaken for a marker (or
+        for a wrapped value) when loaded
+        """
+        if isinstance(data, dict) and (
+            SideValue.MARKER in data or self.ESCAPED in data
+        ):
+            return {self.ESCAPED: data}
+        return data
+
+    def _swap_in(self, userid, channel, data, side_value):
+        """
+        Replace an in-memory value with its side file, if it hasn't changed
+        since (on the event loop thread)
+        """
+        channels = self.db.get(userid, {})
+        if channels.get(channel, None) is data:
+            channels[channel] = side_value
+
+    def _writer_main(self, shadow):
+        """
+        Background thread that appends queued changes to the journal
+        """
+        journal = open(self.journal_filename, "a")
+        last_sync = time.monotonic()
+        unsynced = False
+        superseded = []
+        stop = False
+        while not stop:
+            # Block for the next change, but only for as long as we can
+            # leave an fsync outstanding
+            timeout = None
+            if unsynced and self.fsync == "interval":
+                timeout = max(0, last_sync + self.fsync_interval - time.monotonic())
+            try:
+                batch = [self.write_q.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+
+            # Group together everything else that's already queued
+            while True:
+                try:
+                    batch.append(self.write_q.get_nowait())
+                except queue.Empty:
+                    break
+
+            futs = []
+            exc = None
+            try:
+                for item in batch:
+                    if item is None:
+                        stop = True
+                        continue
+                    userid, channel, data, loop, fut = item
+                    channels = shadow.setdefault(userid, {})
+                    old_data = channels.get(channel, None)
+                    encoded = ujson.dumps(self._escape(data))
+                    if (
+                        self.side_file_bytes
+                        and len(encoded) > self.side_file_bytes
+                        and isinstance(data, (list, str))
+                    ):
+                        side_value = SideValue.create(
+                            self.side_dir, data, fsync=self.fsync != "never"
+                        )
+                        loop.call_soon_threadsafe(
+                            self._swap_in, userid, channel, data, side_value
+                        )
+                        channels[channel] = side_value
+                        encoded = ujson.dumps(side_value.marker())
+                    else:
+                        channels[channel] = data
+                    journal.write(
+                        "[{},{},{}]\n".format(
+                            ujson.dumps(userid), ujson.dumps(channel), encoded
+                        )
+                    )
+                    if isinstance(old_data, SideValue):
+                        superseded.append(old_data)
+                    unsynced = True
+                    if fut is not None:
+                        futs.append(fut)
+                journal.flush()
+
+                now = time.monotonic()
+                if unsynced and (
+                    self.fsync == "always"
+                    or stop
+                    or (
+                        self.fsync == "interval"
+                        and now - last_sync >= self.fsync_interval
+                    )
+                ):
+                    os.fsync(journal.fileno())
+                    last_sync = now
+                    unsynced = False
+
+                # Side files are only deleted once nothing durable refers
+                # to them
+                if not unsynced or self.fsync == "never":
+                    for side_value in superseded:
+                        side_value.delete()
+                    superseded = []
+
+                if journal.tell() > self.compact_bytes:
+                    journal = self._compact(shadow, journal)
+            except Exception as e:
+                log.error("Failed to write %s: %s", self.journal_filename, e)
+                exc = e
+
+            for fut in futs:
+                fut.get_loop().call_soon_threadsafe(_resolve, fut, exc)
+
+        journal.close()
+
+    def _compact(self, shadow, journal):
+        """
+        Write out a new snapshot and start an empty journal
+        """
+        tmp_filename = self.filename + ".tmp"
+        snapshot = {
+            userid: {
+                channel: (
+                    data.marker() if isinstance(data, SideValue) else self._escape(data)
+                )
+                for channel, data in channels.items()
+            }
+            for userid, channels in shadow.items()
+        }
+        with open(tmp_filename, "w") as f:
+            f.write(ujson.dumps(snapshot))
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+        # If we die before truncating, then replaying the journal on top of
+        # the new snapshot is harmless
+        journal.close()
+        return open(self.journal_filename, "w")
+
+
+def _resolve(fut, exc):
+    """
+    Complete a future for a written change (on the event loop thread)
+    """
+    if fut.done():
+        return
+    if exc is None:
+        fut.set_result(None)
+    else:
+        fut.set_exception(exc)
+
+
+class SideValue:
+    """
+    A large list or string value kept in a file rather than in memory, and
+    read via mmap. A list is stored as one JSON-encoded item per line, and a
+    string as UTF-8. An index (the offset of each line for a list, or of every
+    CHUNK-th character for a string) allows a range to be read without
+    decoding the whole value. The index is rebuilt on first use after a
+    restart.
+    """
+
+    CHUNK = 4096
+    MARKER = "__persist_side_file__"
+
+    def __init__(self, path, kind, length, index=None):
+        self.path = path
+        self.kind = kind
+        self.length = length
+        self.index = index
+        self.mmap = None
+        # Reads happen in executor threads
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, directory, data, fsync):
+        """
+        Write out a new side file for a list or string
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, uuid.uuid4().hex)
+        index = array.array("Q")
+        pos = 0
+        with open(path, "wb") as f:
+            if isinstance(data, str):
+                kind = "str"
+                for i in range(0, len(data), cls.CHUNK):
+                    raw = data[i : i + cls.CHUNK].encode()
+                    index.append(pos)
+                    f.write(raw)
+                    pos += len(raw)
+            else:
+                kind = "list"
+                for item in data:
+                    raw = (ujson.dumps(item) + "\n").encode()
+                    index.append(pos)
+                    f.write(raw)
+                    pos += len(raw)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return cls(path, kind, len(data), index)
+
+    @classmethod
+    def from_marker(cls, directory, marker):
+        """
+        Refer to an existing side file, as described by marker(). Raises
+        ValueError unless the marker names a file that create() could have
+        made, in the given directory.
+        """
+        name = marker[cls.MARKER]
+        if not isinstance(name, str) or not _side_file_name.fullmatch(name):
+            raise ValueError("Invalid side file name {!r}".format(name))
+        path = os.path.join(directory, name)
+        real_dir = os.path.realpath(directory)
+        if os.path.commonpath([real_dir, os.path.realpath(path)]) != real_dir:
+            raise ValueError("Side file {} is outside {}".format(path, directory))
+        if marker.get("kind") not in ("str", "list"):
+            raise ValueError("Invalid side file kind {!r}".format(marker.get("kind")))
+        return cls(path, marker["kind"], marker["length"])
+
+    def marker(self):
+        """
+        JSONable reference to this side file, for the journal and snapshot
+        """
+        return {
+            self.MARKER: os.path.basename(self.path),
+            "kind": self.kind,
+            "length": self.length,
+        }
+
+    def load(self):
+        """
+        Read back the whole value
+        """
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        if self.kind == "str":
+            return raw.decode()
+        return [ujson.loads(line) for line in raw.splitlines()]
+
+    def range(self, offset, length):
+        """
+        As per PersistStore.get_range
+        """
+        _check_range(offset, length)
+        with self.lock:
+            self._open()
+        start = offset
+        end = self.length if length is None else min(self.length, start + length)
+        if self.kind == "str":
+            if end <= start:
+                return "", self.length
+            # Decode from the preceding index point, reading enough bytes for
+            # even the worst case of 4 bytes per character
+            skip = start % self.CHUNK
+            begin = self.index[start // self.CHUNK]
+            raw = self.mmap[begin : begin + 4 * (skip + end - start)]
+            text = raw.decode(errors="ignore")
+            return text[skip : skip + end - start], self.length
+        else:
+            if end <= start:
+                return [], self.length
+            begin = self.index[start]
+            finish = self.index[end] if end < len(self.index) else len(self.mmap)
+            lines = self.mmap[begin:finish].splitlines()
+            return [ujson.loads(line) for line in lines], self.length
+
+    def delete(self):
+        """
+        Remove the side file, once superseded
+        """
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            log.warning("Failed to remove %s: %s", self.path, e)
+
+    def _open(self):
+        """
+        Map the file, and build the index if we don't have it
+        """
+        if self.mmap is not None:
+            return
+        with open(self.path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index is None:
+            index = array.array("Q")
+            if self.kind == "str":
+                text = self.mmap[:].decode()
+                pos = 0
+                for i in range(0, len(text), self.CHUNK):
+                    index.append(pos)
+                    pos += len(text[i : i + self.CHUNK].encode())
+            else:
+                pos = 0
+                while pos < len(self.mmap):
+                    index.append(pos)
+                    newline = self.mmap.find(b"\n", pos)
+                    if newline < 0:
+                        break
+                    pos = newline + 1
+            self.index = index
+
+
+# Side file names, as generated by SideValue.create
+_side_file_name = re.compile(r"[0-9a-f]{32}")
+
+
+def _slice(data, offset, length):
+    """
+    As per PersistStore.get_range, for an in-memory value
+    """
+    if not isinstance(data, (list, str)):
+        raise ValueError("Can only load a range of a list or string")
+    _check_range(offset, length)
+    end = len(data) if length is None else offset + length
+    return data[offset:end], len(data)
+
+
+def _check_range(offset, length):
+    """
+    Reject a range that Python slicing would take to count from the end
+    """
+    if offset < 0:
+        raise ValueError("Offset must not be negative")
+    if length is not None and length < 0:
+        raise ValueError("Length must not be negative")
+
+
+class SQLiteStore(PersistStore):
+    """
+    Persist database in SQLite, with one row per (userid, channel), so that
+    the cost of a load or save depends only on the size of that one value.
+
+    All database access (including JSON encoding and decoding) happens in a
+    dedicated single-thread executor, which owns the sqlite3 connection and
+    keeps operations in order. Saves without wait are queued there and not
+    waited for.
+    """
+
+    # How much durability to ask of SQLite for each fsync policy
+    synchronous = {"always": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="persist-sqlite"
+        )
+        self.db = None
+        # Any failure here will show up on first use
+        self.executor.submit(self._connect)
+        atexit.register(self.close)
+
+    async def get(self, userid, channel):
+        return await self._run(self._get, userid, channel)
+
+    async def set(self, userid, channel, data, wait=False):
+        fut = self._run(self._set, userid, channel, data)
+        if wait:
+            await fut
+        else:
+            fut.add_done_callback(self._log_failure)
+
+    def close(self):
+        try:
+            self.executor.submit(self._close)
+        except RuntimeError:
+            # Already shut down, either by an earlier close or at exit
+            pass
+        self.executor.shutdown(wait=True)
+
+    def _run(self, fn, *args):
+        """
+        Run a function in our executor, returning an asyncio future
+        """
+        return asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    def _log_failure(self, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            log.error("Failed to write %s: %s", self.filename, fut.exception())
+
+    #
+    # The rest runs in the executor thread
+    #
+    def _connect(self):
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous={}".format(self.synchronous[self.fsync]))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS persist ("
+            " userid TEXT NOT NULL,"
+            " channel TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " PRIMARY KEY (userid, channel)"
+            ") WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def _get(self, userid, channel):
+        row = self.db.execute(
+            "SELECT data FROM persist WHERE userid = ? AND channel = ?",
+            (userid, channel),
+        ).fetchone()
+        if row is None:
+            raise KeyError((userid, channel))
+        return ujson.loads(row[0])
+
+    def _set(self, userid, channel, data):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO persist (userid, channel, data)"
+                " VALUES (?, ?, ?)",
+                (userid, channel, ujson.dumps(data)),
+            )
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+# Map of backend names (for the "backend" config item) to store classes
+store_by_name = {"journal": JournalStore, "sqlite": SQLiteStore}
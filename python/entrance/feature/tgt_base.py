@@ -2,7 +2,7 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import logging, time
+import asyncio, logging, time
 
 from ..connection import connection_factory_by_name, ConState, Connection
 from .._util import events
@@ -38,6 +38,18 @@ class TargetFeature(DynamicFeature):
         self.parent_target_group = None
         self.connect_requested = False
 
+        # Last known state of each child, and how many children are in each
+        # state, so the aggregate state is cheap to maintain. Only ever
+        # modify self.children via _add_child/_remove_child.
+        self.child_states = {}
+        self.state_counts = [0] * len(ConState)
+
+        # Optionally coalesce bursts of child state changes into a single
+        # notification, sent this many seconds after the first of them
+        self.state_debounce = original_request.get("con_state_debounce", 0)
+        self.pending_state_nfn = None
+        self.pending_state_child = None
+
         # If the client has requested connection state updates, then set up
         # the common part of each notification message now
         if original_request.get("con_state_subscribe", False):
@@ -99,10 +111,29 @@ class TargetFeature(DynamicFeature):
         of global connection state monitoring
         """
         if from_scratch:
-            self.children = set()
-        self.children.add(connection)
+            for child in list(self.children):
+                self._remove_child(child)
+        self._add_child(connection)
         connection.add_state_listener(self.state_listener)
 
+    async def remove_connection(self, connection):
+        """
+        Dissociate a Connection object that is staying up (eg because it is
+        shared with other features), treating it as disconnected from our point
+        of view
+        """
+        connection.remove_state_listener(self.state_listener)
+        self._remove_child(connection)
+        await self._update_state(connection, ConState.DISCONNECTED)
+
+    def close(self):
+        """
+        Websocket has closed, so drop any pending state notification
+        """
+        if self.pending_state_nfn is not None:
+            self.pending_state_nfn.cancel()
+            self.pending_state_nfn = None
+
     async def state_listener(self, child):
         """
         Callback when one of our feature's connections changes state
@@ -112,35 +143,93 @@ class TargetFeature(DynamicFeature):
             # to us, but we don't care any more
             return
 
-        # Calculate aggregate state across all child connections/features
-        self.state = child.state
-        for c in self.children:
-            if c.state > self.state:
-                self.state = c.state
-
-        # Send the notification if we were asked to
-        if self.state_subscription_nfn is not None:
+        # Keep the per-state counts up to date
+        old_child_state = self.child_states[child]
+        if child.state != old_child_state:
+            self.state_counts[old_child_state] -= 1
+            self.state_counts[child.state] += 1
+            self.child_states[child] = child.state
 
-            def encode_state(state):
-                return {
-                    "state": state.name,
-                    "error": state.failure_reason if state.is_failure() else "",
-                }
-
-            nfn = self.state_subscription_nfn.copy()
-            nfn["child"] = child.name
-            nfn["child_state"] = encode_state(child.state)
-            nfn["feature"] = self.name
-            nfn["state"] = encode_state(self.state)
-            nfn["state_is_up"] = self.state == ConState.CONNECTED
-            nfn["timestamp"] = time.strftime("%H:%M:%S")
-            await self._notify(**nfn)
-
-        # Independently notify our target manager, if there is one
-        if self.parent_target_group is not None:
-            await self.parent_target_group.state_listener(self)
+        await self._update_state(child, child.state)
 
         # If a connection object has disconnected, then throw it away - we'll
         # create a new one if there's another connection request later
         if child.state == ConState.DISCONNECTED and isinstance(child, Connection):
+            self._remove_child(child)
+
+    def _add_child(self, child):
+        """
+        Add a child connection or feature, counting its current state
+        """
+        if child not in self.children:
+            self.children.add(child)
+            self.child_states[child] = child.state
+            self.state_counts[child.state] += 1
+
+    def _remove_child(self, child):
+        """
+        Remove a child connection or feature
+        """
+        if child in self.children:
             self.children.remove(child)
+            self.state_counts[self.child_states.pop(child)] -= 1
+
+    async def _update_state(self, child, child_state):
+        """
+        Recompute our aggregate state after a child changed to child_state,
+        and notify anyone interested
+        """
+        # Aggregate state is the max across all child connections/features
+        old_state = self.state
+        self.state = ConState.DISCONNECTED
+        for state in reversed(ConState):
+            if self.state_counts[state] > 0:
+                self.state = state
+                break
+
+        # Send the notification if we were asked to, either now or at the end
+        # of the debounce window
+        if self.state_subscription_nfn is not None:
+            if not self.state_debounce:
+                await self._notify_state(child, child_state)
+            else:
+                self.pending_state_child = (child, child_state)
+                if self.pending_state_nfn is None:
+                    self.pending_state_nfn = asyncio.get_event_loop().call_later(
+                        self.state_debounce, self._flush_state_nfn
+                    )
+
+        # Independently notify our target manager, if there is one and it
+        # has something to hear
+        if self.parent_target_group is not None and self.state != old_state:
+            await self.parent_target_group.state_listener(self)
+
+    def _flush_state_nfn(self):
+        """
+        End of a debounce window: notify the latest state
+        """
+        self.pending_state_nfn = None
+        events.create_checked_task(self._notify_state(*self.pending_state_child))
+
+    async def _notify_state(self, child, child_state):
+        """
+        Send a connection_state notification
+        """
+        nfn = self.state_subscription_nfn.copy()
+        nfn["child"] = child.name
+        nfn["child_state"] = _encode_state(child_state)
+        nfn["feature"] = self.name
+        nfn["state"] = _encode_state(self.state)
+        nfn["state_is_up"] = self.state == ConState.CONNECTED
+        nfn["timestamp"] = time.strftime("%H:%M:%S")
+        await self._notify(**nfn)
+
+
+def _encode_state(state):
+    """
+    Encode a ConState for a connection_state notification
+    """
+    return {
+        "state": state.name,
+        "error": state.failure_reason if state.is_failure() else "",
+    }
@@ -2,19 +2,30 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
+import asyncio, time
+
+from ..connection import ConState
 from .._util import events
-from .tgt_base import TargetFeature
+from .tgt_base import TargetFeature, _encode_state
 
 
 class TargetGroupFeature(TargetFeature):
     """
     Feature that manages a set (or subtree) of target features
+
+    For large groups, the start_feature request can specify
+    con_state_snapshot (in seconds) instead of con_state_subscribe. Rather
+    than a connection_state notification for every child transition, there
+    is then at most one connection_state_snapshot notification per that
+    interval, with the number of children in each state and the members that
+    changed since the last one.
     """
 
     #
     # Schema
     #
     name = "target_group"
+    notifications = ["connection_state_snapshot"]
 
     #
     # Implementation
@@ -26,6 +37,18 @@ class TargetGroupFeature(TargetFeature):
         super().__init__(ws_handler, channel, target, original_request)
         self.parent_target = original_request.get("parent_target", None)
 
+        # Snapshot mode: remember the latest state of each changed child until
+        # the next snapshot is due
+        self.snapshot_interval = original_request.get("con_state_snapshot", None)
+        self.snapshot_changes = {}
+        self.pending_snapshot = None
+        if self.snapshot_interval is not None:
+            self.state_debounce = 0
+            if self.state_subscription_nfn is None:
+                self.state_subscription_nfn = {"feature": self.name}
+                if "id" in original_request:
+                    self.state_subscription_nfn["id"] = original_request["id"]
+
         # If there are target features for our member target that have
         # already been started, associate them with us now. Any ones created
         # subsequently will automatically invoke our add_feature() method.
@@ -44,7 +67,7 @@ class TargetGroupFeature(TargetFeature):
         """
         Add a target feature for our target
         """
-        self.children.add(feature)
+        self._add_child(feature)
         feature.parent_target_group = self
         if self.connect_requested:
             # A connect request has already been made. So the late-arrival
@@ -55,4 +78,52 @@ class TargetGroupFeature(TargetFeature):
         """
         Remove a target feature from our target
         """
-        self.children.remove(feature)
+        self._remove_child(feature)
+
+    def close(self):
+        """
+        Websocket has closed, so drop any pending snapshot
+        """
+        super().close()
+        if self.pending_snapshot is not None:
+            self.pending_snapshot.cancel()
+            self.pending_snapshot = None
+
+    async def _notify_state(self, child, child_state):
+        """
+        In snapshot mode, just note the change for the next snapshot
+        """
+        if self.snapshot_interval is None:
+            await super()._notify_state(child, child_state)
+            return
+        self.snapshot_changes[child] = child_state
+        if self.pending_snapshot is None:
+            self.pending_snapshot = asyncio.get_event_loop().call_later(
+                self.snapshot_interval, self._flush_snapshot
+            )
+
+    def _flush_snapshot(self):
+        """
+        Send a connection_state_snapshot with everything since the last one
+        """
+        self.pending_snapshot = None
+        nfn = self.state_subscription_nfn.copy()
+        nfn["nfn_type"] = "connection_state_snapshot"
+        nfn["state"] = _encode_state(self.state)
+        nfn["state_is_up"] = self.state == ConState.CONNECTED
+        nfn["counts"] = {
+            state.name: self.state_counts[state]
+            for state in ConState
+            if self.state_counts[state] > 0
+        }
+        nfn["changed"] = [
+            {
+                "child": child.name,
+                "target": getattr(child, "target", None),
+                "state": _encode_state(state),
+            }
+            for child, state in self.snapshot_changes.items()
+        ]
+        nfn["timestamp"] = time.strftime("%H:%M:%S")
+        self.snapshot_changes = {}
+        events.create_checked_task(self._notify(**nfn))
@@ -2,6 +2,8 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
+import asyncio
+
 from .tgt_base import TargetFeature
 
 
@@ -14,7 +16,10 @@ class NetconfFeature(TargetFeature):
     # Schema
     #
     name = "netconf"
-    requests = {"netconf": ["op", "__req__"]}
+    requests = {
+        "netconf": ["op", "__req__"],
+        "netconf_transaction": ["ops"],
+    }
 
     # We decode out the actual netconf op as follows
     op_requests = {
@@ -26,6 +31,10 @@ class NetconfFeature(TargetFeature):
         "discard_changes": [],
     }
 
+    # Any request or transaction op can also include an optional "select"
+    # dict, in which case a successful reply is a JSON projection of just the
+    # selected leaves rather than the full XML (see ThreadedNCConnection.project)
+
     #
     # Implementation
     #
@@ -44,25 +53,50 @@ class NetconfFeature(TargetFeature):
             fn = getattr(self.connection, op)
             args = [req[arg] for arg in self.op_requests[op]]
             rpc_reply = await fn(*args)
-            result = str(rpc_reply)
+            if not self.connection.reply_ok(op, rpc_reply):
+                return self._rpc_failure(str(rpc_reply))
+            return self._rpc_success(await self._reply_value(rpc_reply, req))
 
-            # Semi-hack for commit check:
-            #
-            # If a validate operation returns errors, but they all have
-            # severity 'warning' not 'error', then consider the operation
-            # a success
-            if (
-                op == "validate"
-                and not rpc_reply.ok
-                and not "<error-severity>error</error-severity>" in result
-            ):
-                return self._rpc_success(result)
+        except Exception as e:
+            return self._rpc_failure(str(e))
 
-            # Usual processing
-            elif rpc_reply.ok:
-                return self._rpc_success(result)
-            else:
-                return self._rpc_failure(result)
+    async def do_netconf_transaction(self, ops):
+        """
+        Do a list of netconf operations (each a dict with an "op" and any
+        arguments specified in op_requests) in a single round trip to the
+        worker thread, stopping at the first failure. The reply carries the
+        result of each operation attempted.
+        """
+        try:
+            tx_ops = []
+            for op_req in ops:
+                op = op_req["op"]
+                if op not in self.op_requests:
+                    return self._rpc_failure("Unknown netconf op {}".format(op))
+                tx_ops.append((op, [op_req[arg] for arg in self.op_requests[op]]))
+            replies = await self.connection.transaction(tx_ops)
+            results = []
+            for op_req, (op, rpc_reply) in zip(ops, replies):
+                if not self.connection.reply_ok(op, rpc_reply):
+                    results.append({"op": op, "result": str(rpc_reply)})
+                    return self._rpc_failure(str(rpc_reply), results=results)
+                value = await self._reply_value(rpc_reply, op_req)
+                results.append({"op": op, "result": value})
+            return self._rpc_success(results)
 
         except Exception as e:
             return self._rpc_failure(str(e))
+
+    async def _reply_value(self, rpc_reply, req):
+        """
+        The value to return for a successful rpc_reply: either the raw XML, or
+        if requested a projection of it (computed in the default executor, to
+        keep XML parsing off the event loop)
+        """
+        select = req.get("select", None)
+        if select is None:
+            return str(rpc_reply)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, self.connection.project, rpc_reply, select
+        )
@@ -2,74 +2,670 @@
 #
 # Copyright (c) 2018 Ensoft Ltd
 
-import re, time
+import asyncio, bisect, collections, hashlib, logging, re, time
 
+from ..connection import ConState
+from ..exceptions import EntranceError
 from .._util import events
 from .tgt_base import TargetFeature
 
+log = logging.getLogger(__name__)
+
 
 class SyslogFeature(TargetFeature):
     """
     Feature that monitors for syslogs, with optional debugs and filtering.
+
+    All SyslogFeature instances (across all websockets) for the same router
+    share a single _SyslogStream, ie a single "terminal monitor" session.
+    The stream hands matching lines to each subscriber without waiting, and
+    each subscriber sends them on from its own task, so a slow websocket
+    only holds up itself (dropping lines beyond MAX_PENDING_SYSLOGS).
+
+    By default each matching line is sent as its own "syslog" notification.
+    The start_feature request can instead ask for "syslog_batch"
+    notifications, via any of these optional parameters:
+
+    - batch_interval: send at most one notification per this many seconds,
+      carrying all lines received in that window (default 0, ie one
+      notification per chunk read from the router)
+    - max_rate: forward at most this many lines per second to this
+      subscription (other subscribers to the same router have their own
+      caps), dropping any excess and reporting the number dropped in the
+      next notification
+    - collapse_repeats: if true, send identical messages (ignoring their
+      timestamps) within one batch just once, with a repeat count
+
+    Recent lines from each router are also kept in a bounded in-memory
+    history (see _SyslogHistory), which survives page reloads and can be
+    queried with the syslog_replay and syslog_search requests. The optional
+    history_bytes parameter sets the memory bound for the router's history
+    (up to MAX_HISTORY_BYTES), which is the largest bound wanted by any
+    current subscriber. A history is dropped once nobody has monitored
+    its router for HISTORY_TTL seconds.
     """
 
     #
     # Schema
     #
     name = "syslog"
-    notifications = ["syslog"]
+    requests = {
+        "syslog_replay": ["?since", "?limit"],
+        "syslog_search": ["?keywords", "?pattern", "?since", "?limit"],
+    }
+    notifications = ["syslog", "syslog_batch"]
 
     #
     # Implementation
     #
+    def __init__(self, ws_handler, channel, target, original_request):
+        super().__init__(ws_handler, channel, target, original_request)
+        self.stream = None
+        self.connection = None
+        self.history = None
+
+        # Lines waiting to be sent, by the sender task, and how many have
+        # been dropped since the outbox was last empty
+        self.outbox = asyncio.Queue(MAX_PENDING_SYSLOGS)
+        self.sender = None
+        self.dropped = 0
+
+        # Filters and debugs from the start_feature req
+        self.filters = original_request.get("filters", [])
+        if len(self.filters) == 0:
+            # just drop empty lines
+            self.filters = [r"\S"]
+        self.regexp = re.compile("|".join(["({})".format(f) for f in self.filters]))
+        self.debugs = original_request.get("debugs", [])
+
+        # How much history we want kept for the router (the history actually
+        # kept is the most that any current subscriber wants)
+        self.history_bytes = original_request.get(
+            "history_bytes", DEFAULT_HISTORY_BYTES
+        )
+        if self.history_bytes > MAX_HISTORY_BYTES:
+            log.info(
+                "Limiting syslog history to %d bytes, rather than %d",
+                MAX_HISTORY_BYTES,
+                self.history_bytes,
+            )
+            self.history_bytes = MAX_HISTORY_BYTES
+
+        # Common part of every notification
+        self.nfn = {"nfn_type": "syslog", "channel": original_request["channel"]}
+        if "id" in original_request:
+            self.nfn["id"] = original_request["id"]
+        if any(
+            opt in original_request
+            for opt in ("batch_interval", "max_rate", "collapse_repeats")
+        ):
+            max_rate = original_request.get("max_rate", None)
+            if max_rate is not None and max_rate <= 0:
+                raise EntranceError("max_rate must be positive")
+            self.batcher = _SyslogBatcher(
+                self,
+                dict(self.nfn, nfn_type="syslog_batch"),
+                original_request.get("batch_interval", 0),
+                max_rate,
+                original_request.get("collapse_repeats", False),
+            )
+        else:
+            self.batcher = None
+
     async def connect(self, conn_factory):
         """
-        Set up our connection to the router
+        Attach to the shared stream for this router, creating it (and its
+        connection) if we are the first subscriber
+        """
+        if self.stream is not None:
+            await self._detach()
+        key = _stream_key(conn_factory)
+        stream = _streams.get(key, None)
+        if stream is None:
+            history = _histories.get(key, None)
+            if history is None:
+                history = _SyslogHistory(DEFAULT_HISTORY_BYTES)
+                _histories[key] = history
+            elif history.expiry is not None:
+                history.expiry.cancel()
+                history.expiry = None
+            stream = _SyslogStream(key, history)
+            _streams[key] = stream
+        self.stream = stream
+        self.history = stream.history
+        await stream.subscribe(self, conn_factory)
+
+    async def disconnect(self):
+        """
+        Leave the shared stream. The connection is only torn down when the last
+        subscriber leaves.
+        """
+        await self._detach()
+
+    def close(self):
+        """
+        Websocket has closed, so stop listening and don't try to send any
+        pending batch
+        """
+        super().close()
+        if self.batcher is not None:
+            self.batcher.cancel()
+        self._stop_sender()
+        if self.stream is not None:
+            self.stream.unsubscribe(self)
+            self.stream = None
+        if self.connection is not None:
+            # The connection may be staying up for other subscribers, so stop
+            # it calling back into this dead feature
+            if self.state_listener in self.connection.state_listeners:
+                self.connection.remove_state_listener(self.state_listener)
+            self._remove_child(self.connection)
+            self.connection = None
+
+    async def _detach(self):
+        """
+        Unsubscribe from our stream
+        """
+        stream, self.stream = self.stream, None
+        if stream is None:
+            return
+        last_one = stream.unsubscribe(self)
+        if self.batcher is not None:
+            self.batcher.cancel()
+        self._stop_sender()
+        if not last_one and self.connection is not None:
+            # Connection stays up for everyone else
+            await self.remove_connection(self.connection)
+
+    async def do_syslog_replay(self, since=None, limit=None):
+        """
+        Return recent lines from the router's history that match our filters,
+        optionally only those since a given time
+        """
+        if self.history is None:
+            return self._rpc_failure("No syslog history until connected")
+        return self._rpc_success(
+            self.history.search(regexp=self.regexp, since=since, limit=limit)
+        )
+
+    async def do_syslog_search(
+        self, keywords=None, pattern=None, since=None, limit=None
+    ):
+        """
+        Search the router's history for lines containing all the given
+        keywords (whole words, case-insensitive) and/or matching a regexp
+        """
+        if self.history is None:
+            return self._rpc_failure("No syslog history until connected")
+        regexp = re.compile(pattern) if pattern else None
+        return self._rpc_success(
+            self.history.search(
+                keywords=keywords, regexp=regexp, since=since, limit=limit
+            )
+        )
+
+    def deliver(self, syslog, timestamp):
+        """
+        Take a syslog line matching our filters, to be sent on by our sender
+        task (or batcher). Never blocks.
+        """
+        if self.batcher is not None:
+            self.batcher.add(syslog, timestamp)
+            return
+        if self.sender is None:
+            self.sender = events.create_checked_task(self._send_syslogs())
+        try:
+            self.outbox.put_nowait((syslog, timestamp))
+        except asyncio.QueueFull:
+            if self.dropped == 0:
+                log.warning("Dropping syslogs for slow subscriber %s", self.channel)
+            self.dropped += 1
+
+    async def _send_syslogs(self):
+        """
+        Sender task: forward queued syslog lines, one notification each
+        """
+        while True:
+            syslog, timestamp = await self.outbox.get()
+            nfn = dict(self.nfn, result=syslog, time=timestamp)
+            try:
+                await self._notify(**nfn)
+            except Exception as e:
+                log.debug("Dropping syslog for subscriber: %s", e)
+            if self.dropped and self.outbox.empty():
+                log.warning(
+                    "Dropped %d syslogs for slow subscriber %s",
+                    self.dropped,
+                    self.channel,
+                )
+                self.dropped = 0
+
+    def _stop_sender(self):
+        """
+        Stop sending, throwing away anything still queued
+        """
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
+        self.outbox = asyncio.Queue(MAX_PENDING_SYSLOGS)
+
+
+# Shared streams, keyed by router
+_streams = {}
+
+# Syslog histories, keyed by router. These outlive the streams (for up to
+# HISTORY_TTL seconds), so that a page reload (say) can still get at what
+# happened just before.
+_histories = {}
+
+# Default memory bound for each router's history, and the most that a client
+# can ask for. These and HISTORY_TTL can be set in the server's start config
+# (see server.create_app).
+DEFAULT_HISTORY_BYTES = 1000000
+MAX_HISTORY_BYTES = 10000000
+
+# How long to keep a router's history once nobody is monitoring it
+HISTORY_TTL = 3600
+
+# Most syslog lines queued for any one subscriber, beyond which they are
+# dropped
+MAX_PENDING_SYSLOGS = 10000
+
+
+def _stream_key(conn_factory):
+    """
+    Identify the router that a connection factory connects to, and the
+    credentials used. Only clients that could have logged in themselves get
+    to share a stream (and its history), so a digest of the secret is part of
+    the key - the secret itself isn't kept.
+    """
+    kwargs = conn_factory.kwargs
+    secret = hashlib.sha256()
+    for field in ("password", "ssh_key"):
+        secret.update(repr(kwargs.get(field, None)).encode())
+    return (
+        type(conn_factory).__name__,
+        kwargs.get("host", None),
+        str(kwargs.get("ssh_port", "22")),
+        kwargs.get("username", None),
+        secret.hexdigest(),
+    )
+
+
+def _expire_history(key, history):
+    """
+    Drop a history that nobody has monitored for HISTORY_TTL seconds
+    """
+    if _histories.get(key, None) is history:
+        del _histories[key]
+
+
+class _SyslogStream:
+    """
+    A single syslog CLI session to a router, shared by every SyslogFeature
+    monitoring that router. Each incoming line is matched against the
+    distinct filters across all subscribers with a single regexp call, using
+    one optional lookahead group per filter. (That saves matching the same
+    filter once per subscriber, but each filter is still tried separately,
+    so the cost grows with the number of distinct filters.)
+    """
+
+    def __init__(self, key, history):
+        self.key = key
+        self.history = history
+        self.subscribers = []
+        self.connection = None
+        self.connect_lock = asyncio.Lock()
+        self.event_loop_task = None
+        self.debugs_sent = set()
+        self._rebuild_matcher()
+
+    async def subscribe(self, feature, conn_factory):
+        """
+        Add a subscriber, connecting if required
+        """
+        self.subscribers.append(feature)
+        self._rebuild_matcher()
+        self._resize_history()
+        async with self.connect_lock:
+            if self.connection is None or self.connection.state in (
+                ConState.DISCONNECTED,
+                ConState.FAILED_TO_CONNECT,
+            ):
+                # Nothing to share yet, or a previous attempt is dead
+                self.connection = await conn_factory.get_cli_connection(
+                    "syslog", finalizer=self.finalizer
+                )
+        feature.connection = self.connection
+        feature.add_connection(self.connection, from_scratch=True)
+        if self.connection.state != ConState.DISCONNECTED:
+            # Catch the newcomer up with the current connection state, and
+            # turn on any new debugs it wants (we can't wait for the prompt
+            # as the output is all going to the event loop)
+            await feature.state_listener(self.connection)
+            if self.connection.state == ConState.CONNECTED:
+                for debug in feature.debugs:
+                    if debug not in self.debugs_sent:
+                        self.debugs_sent.add(debug)
+                        await self.connection.send("{}\n".format(debug))
+
+    def unsubscribe(self, feature):
+        """
+        Remove a subscriber, disconnecting if it was the last one. Returns
+        whether this was the last subscriber.
+        """
+        if feature not in self.subscribers:
+            return False
+        self.subscribers.remove(feature)
+        if len(self.subscribers) > 0:
+            self._rebuild_matcher()
+            self._resize_history()
+            return False
+        if _streams.get(self.key, None) is self:
+            del _streams[self.key]
+            self.history.expiry = asyncio.get_event_loop().call_later(
+                HISTORY_TTL, _expire_history, self.key, self.history
+            )
+        if self.connection is not None:
+            events.create_checked_task(self.connection.disconnect())
+        return True
+
+    def _resize_history(self):
+        """
+        Keep as much history as any subscriber wants (and no more)
+        """
+        self.history.resize(
+            max(max(0, feature.history_bytes) for feature in self.subscribers)
+        )
+
+    def _rebuild_matcher(self):
         """
-        self.connection = await conn_factory.get_cli_connection(
-            "syslog", finalizer=self.finalizer
+        Compile a single regexp that finds which of the distinct filters
+        across all subscribers match a line
+        """
+        patterns = []
+        self.subscribers_by_group = []
+        for feature in self.subscribers:
+            for f in feature.filters:
+                if f not in patterns:
+                    patterns.append(f)
+                    self.subscribers_by_group.append([])
+                subscribers = self.subscribers_by_group[patterns.index(f)]
+                if feature not in subscribers:
+                    subscribers.append(feature)
+        self.regexp = re.compile(
+            "".join(
+                "(?:(?=.*?(?P<f{}>{})))?".format(i, f) for i, f in enumerate(patterns)
+            )
         )
-        self.add_connection(self.connection, from_scratch=True)
+
+    def _match(self, syslog):
+        """
+        Return the subscribers interested in a line
+        """
+        m = self.regexp.match(syslog)
+        matched = []
+        for i, subscribers in enumerate(self.subscribers_by_group):
+            if m.group("f{}".format(i)) is not None:
+                for feature in subscribers:
+                    if feature not in matched:
+                        matched.append(feature)
+        return matched
 
     async def finalizer(self):
         """
         Finalize a new connection
         """
-        # First handle any filters/debug settings from the start_feature req
-        filters = self.original_req.get("filters", [])
-        if len(filters) == 0:
-            # just drop empty lines
-            filters = [r"\S"]
-        regexp = re.compile("|".join(["({})".format(f) for f in filters]))
-        nfn = {"nfn_type": "syslog", "channel": self.original_req["channel"]}
-        if "id" in self.original_req:
-            nfn["id"] = self.original_req["id"]
-
-        # Then do the expect stuff to get us ready to go
+        # Do the expect stuff to get us ready to go
         await self.connection.send("undebug all all-tty\n", override=True)
         await self.connection.expect_prompt(override=True)
         await self.connection.send("terminal monitor\n", override=True)
         await self.connection.expect_prompt(override=True)
-        for debug in self.original_req.get("debugs", []):
-            await self.connection.send("{}\n".format(debug), override=True)
-            await self.connection.expect_prompt(override=True)
+        self.debugs_sent = set()
+        for feature in self.subscribers:
+            for debug in feature.debugs:
+                if debug not in self.debugs_sent:
+                    self.debugs_sent.add(debug)
+                    await self.connection.send("{}\n".format(debug), override=True)
+                    await self.connection.expect_prompt(override=True)
 
         # We need to return at this point, so the connection transitions
         # from FINALIZING to CONNECTED, so tee up our mini event loop for later
-        events.create_checked_task(self._event_loop(regexp, nfn))
+        # (unless still running from before a reconnect)
+        if self.event_loop_task is None or self.event_loop_task.done():
+            self.event_loop_task = events.create_checked_task(self._event_loop())
 
-    async def _event_loop(self, regexp, nfn):
+    async def _event_loop(self):
         """
         Sit and wait for syslogs/debugs to come in
         """
         # poll event loop for disconnect requests occasionally
-        await self.connection.settimeout(1)
+        connection = self.connection
+        await connection.settimeout(1)
 
         # enter event loop
-        while not self.connection.terminate:
-            data = (await self.connection.recv()).decode()
+        while not connection.terminate:
+            data = (await connection.recv()).decode()
+            now = time.time()
             for syslog in data.split("\n"):
-                if regexp.search(syslog):
-                    nfn["result"] = syslog
-                    nfn["time"] = time.time()
-                    await self._notify(**nfn)
+                if syslog.strip():
+                    self.history.add(syslog, now)
+                for feature in self._match(syslog):
+                    feature.deliver(syslog, now)
+
+
+# Words indexed in the syslog history, eg "%MGBL-CONFIG-6-DB_COMMIT" or "ifmgr"
+_keyword = re.compile(r"[\w%-]+")
+
+# Default maximum number of lines returned from the syslog history
+DEFAULT_HISTORY_LIMIT = 1000
+
+
+class _SyslogHistory:
+    """
+    Bounded in-memory history of the syslog lines from one router, with a
+    time index and a keyword index.
+
+    Lines are held as UTF-8 bytes in parallel lists (with their timestamps)
+    that are only ever appended to, with the oldest evicted once the
+    approximate memory cost exceeds max_bytes. Since timestamps arrive in
+    order, the time index is just a bisect of the timestamp list. The keyword
+    index maps each (lower-case) word in a line's message to the sequence
+    numbers of the lines containing it.
+    """
+
+    # Rough bookkeeping cost per line and per keyword posting
+    LINE_OVERHEAD = 64
+    POSTING_OVERHEAD = 16
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.times = []
+        self.lines = []
+        # Index of the oldest live line in the lists above (earlier entries
+        # have been evicted but not yet compacted away), and the sequence
+        # number of the line at index 0
+        self.start = 0
+        self.base_seq = 0
+        self.postings = {}
+        # Timer handle for dropping the history, while nobody is monitoring
+        # the router
+        self.expiry = None
+
+    def add(self, line, timestamp):
+        """
+        Record a line
+        """
+        data = line.encode()
+        words = self._words(line)
+        seq = self.base_seq + len(self.lines)
+        self.times.append(timestamp)
+        self.lines.append(data)
+        for word in words:
+            posting = self.postings.get(word, None)
+            if posting is None:
+                posting = collections.deque()
+                self.postings[word] = posting
+            posting.append(seq)
+        self.size += self._cost(data, words)
+        self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Change the memory bound, evicting lines if necessary
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def search(self, keywords=None, regexp=None, since=None, limit=None):
+        """
+        Return the most recent (up to limit) lines, oldest first, that are
+        at or after the since timestamp, contain all the keywords, and match
+        the regexp
+        """
+        if limit is None:
+            limit = DEFAULT_HISTORY_LIMIT
+        first = self.start
+        if since is not None:
+            first = bisect.bisect_left(self.times, since, lo=self.start)
+
+        if keywords:
+            # Walk the shortest posting list, checking the other keywords
+            wanted = set(k.lower() for k in keywords)
+            postings = [self.postings.get(k, ()) for k in wanted]
+            candidates = (
+                seq - self.base_seq for seq in reversed(min(postings, key=len))
+            )
+        else:
+            wanted = None
+            candidates = range(len(self.lines) - 1, first - 1, -1)
+
+        results = []
+        for i in candidates:
+            if i < first or len(results) >= limit:
+                break
+            line = self.lines[i].decode()
+            if wanted is not None and not wanted.issubset(self._words(line)):
+                continue
+            if regexp is not None and not regexp.search(line):
+                continue
+            results.append({"result": line, "time": self.times[i]})
+        results.reverse()
+        return results
+
+    def _evict(self):
+        """
+        Drop the oldest lines until we're within our memory bound
+        """
+        while self.size > self.max_bytes and self.start < len(self.lines):
+            data = self.lines[self.start]
+            words = self._words(data.decode())
+            for word in words:
+                posting = self.postings[word]
+                posting.popleft()
+                if not posting:
+                    del self.postings[word]
+            self.size -= self._cost(data, words)
+            self.lines[self.start] = None
+            self.start += 1
+
+        # Compact away evicted entries once they're the majority
+        if self.start > 1000 and self.start * 2 > len(self.lines):
+            del self.times[: self.start]
+            del self.lines[: self.start]
+            self.base_seq += self.start
+            self.start = 0
+
+    def _cost(self, data, words):
+        return len(data) + self.LINE_OVERHEAD + len(words) * self.POSTING_OVERHEAD
+
+    @staticmethod
+    def _words(line):
+        """
+        Set of keywords in a line's message
+        """
+        return set(_keyword.findall(_timestamp.sub("", line).lower()))
+
+
+# Leading router name and timestamp, eg "RP/0/RP0/CPU0:Oct 19 10:01:02.345 UTC: "
+_timestamp = re.compile(r"^\S*?\w{3} +\d+ +\d+:\d+:\d+(\.\d+)?( \w+)?: *")
+
+
+class _SyslogBatcher:
+    """
+    Accumulates syslog lines for a single subscription, and sends them as
+    rate-limited, optionally de-duplicated, syslog_batch notifications.
+    """
+
+    def __init__(self, feature, nfn, interval, max_rate, collapse_repeats):
+        self.feature = feature
+        self.nfn = nfn
+        self.interval = interval
+        self.max_rate = max_rate
+        self.collapse_repeats = collapse_repeats
+        self.entries = []
+        self.entries_by_msg = {}
+        self.dropped = 0
+        self.flush_handle = None
+        # Token bucket for the rate cap, allowing bursts of up to a second
+        # (or a single line, for rates below one a second)
+        self.capacity = None if max_rate is None else max(1, max_rate)
+        self.tokens = self.capacity
+        self.tokens_time = time.monotonic()
+
+    def add(self, line, timestamp):
+        """
+        Add a line to the current batch, unless over the rate cap
+        """
+        if self.max_rate is not None:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.tokens_time) * self.max_rate
+            )
+            self.tokens_time = now
+            if self.tokens < 1:
+                self.dropped += 1
+                self._schedule_flush()
+                return
+            self.tokens -= 1
+
+        if self.collapse_repeats:
+            msg = _timestamp.sub("", line)
+            entry = self.entries_by_msg.get(msg, None)
+            if entry is not None:
+                entry["repeats"] += 1
+                entry["last_time"] = timestamp
+                return
+            entry = {"result": line, "time": timestamp, "repeats": 1}
+            self.entries_by_msg[msg] = entry
+        else:
+            entry = {"result": line, "time": timestamp}
+        self.entries.append(entry)
+        self._schedule_flush()
+
+    def cancel(self):
+        """
+        Throw away any pending batch
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+    def _schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(
+                self.interval, self._flush
+            )
+
+    def _flush(self):
+        """
+        Send everything accumulated since the last flush
+        """
+        self.flush_handle = None
+        nfn = dict(self.nfn, result=self.entries, dropped=self.dropped)
+        nfn["time"] = time.time()
+        self.entries = []
+        self.entries_by_msg = {}
+        self.dropped = 0
+        events.create_checked_task(self.feature._notify(**nfn))
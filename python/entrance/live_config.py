@@ -0,0 +1,81 @@
+# Live configuration, reloadable without restarting
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+import logging
+import yaml
+
+from .exceptions import EntranceError
+from .feature import ConfiguredFeature, feature_by_name
+
+log = logging.getLogger(__name__)
+
+# The LiveConfig for this server process, if any (set up by server.create_app)
+current = None
+
+
+class LiveConfig:
+    """
+    Holds the server config, so that the features section can be reloaded
+    from the config file at runtime. Each new websocket session takes the
+    features config current at the time; existing sessions (and so their
+    router connections) are unaffected. A reload is validated in full before
+    being swapped in with a single assignment, so sessions never see a
+    partially-applied config.
+
+    Optionally holds a callback to start a warm hand-off to a fresh server
+    process (see server.create_app).
+    """
+
+    def __init__(self, config, filename=None):
+        self.config = config
+        self.filename = filename
+        self.on_handoff = None
+
+    @property
+    def features(self):
+        return self.config["features"]
+
+    def reload(self):
+        """
+        Re-read the config file, and swap in its features section. Raise
+        EntranceError, leaving the current config alone, if there's anything
+        wrong with it.
+        """
+        if self.filename is None:
+            raise EntranceError("No config file to reload from")
+        try:
+            with open(self.filename) as f:
+                new_config = yaml.safe_load(f.read())
+        except (OSError, yaml.YAMLError) as e:
+            raise EntranceError("Failed to read {}: {}".format(self.filename, e))
+        features = new_config.get("features") if isinstance(new_config, dict) else None
+        if not isinstance(features, dict):
+            raise EntranceError("No features section in {}".format(self.filename))
+        for name, feature_config in features.items():
+            _check_feature_config(name, feature_config or {})
+
+        self.config = {**self.config, "features": features}
+        log.info("Reloaded feature config from %s", self.filename)
+
+    def handoff(self):
+        """
+        Start a warm hand-off to a fresh server process
+        """
+        if self.on_handoff is None:
+            raise EntranceError("Warm hand-off not supported by this server")
+        self.on_handoff()
+
+
+def _check_feature_config(name, feature_config):
+    """
+    Check that a configured feature exists and accepts the given options
+    """
+    feature_cls = feature_by_name.get(name)
+    if feature_cls is None or not issubclass(feature_cls, ConfiguredFeature):
+        raise EntranceError("Unknown configured feature {}".format(name))
+    invalid = set(feature_config) - set(feature_cls.config)
+    if invalid:
+        raise EntranceError(
+            "Invalid config items {} for feature {}".format(sorted(invalid), name)
+        )
@@ -0,0 +1,233 @@
+# Server metrics, in the Prometheus text exposition format
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""Server metrics, in the Prometheus text exposition format."""
+
+import bisect, collections, threading, weakref
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+class Histogram:
+    """
+    Histogram family: one set of bucket counts per tuple of label values.
+    Recording is just a bisect and a few increments, with no locking (all
+    callers are on the event loop thread).
+    """
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., overflow count, sum, count]
+        self.values = {}
+
+    def observe(self, label_values, value):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.help))
+        lines.append("# TYPE {} histogram".format(self.name))
+        for label_values, counts in sorted(self.values.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = '{}le="{}"'.format(labels + "," if labels else "", bound)
+                lines.append(_sample(self.name + "_bucket", bucket_labels, cumulative))
+            lines.append(_sample(self.name + "_sum", labels, counts[-2]))
+            lines.append(_sample(self.name + "_count", labels, counts[-1]))
+
+
+class Gauge:
+    """
+    Gauge family, either set directly (per tuple of label values), or
+    computed on each scrape by a function returning (label values, value)
+    pairs
+    """
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values = {}
+
+    def inc(self, label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, label_values, amount=1):
+        self.values[label_values] -= amount
+
+    def render(self, lines):
+        lines.append("# HELP {} {}".format(self.name, self.help))
+        lines.append("# TYPE {} gauge".format(self.name))
+        values = self.values.items() if self.collect is None else self.collect()
+        for label_values, value in sorted(values):
+            lines.append(_sample(self.name, _labels(self.labels, label_values), value))
+
+
+def _sample(name, labels, value):
+    """
+    Format one sample line
+    """
+    if labels:
+        return "{}{{{}}} {}".format(name, labels, value)
+    return "{} {}".format(name, value)
+
+
+def _labels(names, values):
+    """
+    Format label pairs, escaped as per the exposition format
+    """
+    return ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+
+
+# All live connections, so that their states and queues can be reported
+connections = weakref.WeakSet()
+
+
+def _connection_states():
+    from .connection import ConState
+
+    counts = dict.fromkeys(ConState, 0)
+    for con in list(connections):
+        counts[con.state] += 1
+    return [((state.name,), count) for state, count in counts.items()]
+
+
+def _queue_depths(queue_name):
+    # Many connections can share a type and name (eg one "syslog" connection
+    # per router), so label by host too, and add up any that still clash (eg
+    # several users' connections to the same router)
+    def collect():
+        depths = collections.Counter()
+        for con in list(connections):
+            if hasattr(con, queue_name):
+                host = getattr(con.factory, "kwargs", {}).get("host", "")
+                labels = (type(con).__name__, con.name, str(host))
+                depths[labels] += getattr(con, queue_name).qsize()
+        return depths.items()
+
+    return collect
+
+
+def _threads():
+    return [((), threading.active_count())]
+
+
+# Recent event loop lag measurements (see _util.watchdog), for percentiles
+loop_lag_recent = collections.deque(maxlen=1000)
+
+
+def _loop_lag_quantiles():
+    lags = sorted(loop_lag_recent)
+    if not lags:
+        return []
+    return [
+        ((q,), lags[min(int(q * len(lags)), len(lags) - 1)])
+        for q in (0.5, 0.9, 0.99, 1.0)
+    ]
+
+
+request_latency = Histogram(
+    "entrance_request_seconds",
+    "Time to handle each websocket request",
+    ("feature", "req_type"),
+)
+requests_in_flight = Gauge(
+    "entrance_requests_in_flight",
+    "Websocket requests currently being handled",
+    ("feature", "req_type"),
+)
+notify_latency = Histogram(
+    "entrance_notify_seconds",
+    "Time to send each websocket notification",
+    ("nfn_type",),
+)
+connection_request_latency = Histogram(
+    "entrance_connection_request_seconds",
+    "Time for each request to a connection's worker thread, including queueing",
+    ("connection_type", "action"),
+)
+
+loop_lag = Histogram(
+    "entrance_loop_lag_seconds",
+    "How late the event loop was in running a periodic timer",
+    (),
+)
+
+all_metrics = [
+    request_latency,
+    requests_in_flight,
+    notify_latency,
+    connection_request_latency,
+    loop_lag,
+    Gauge(
+        "entrance_loop_lag_recent_seconds",
+        "Percentiles of the last 1000 event loop lag measurements",
+        ("quantile",),
+        collect=_loop_lag_quantiles,
+    ),
+    Gauge(
+        "entrance_connections",
+        "Connections in each state",
+        ("state",),
+        collect=_connection_states,
+    ),
+    Gauge(
+        "entrance_connection_request_queue_depth",
+        "Requests queued for connections' worker threads",
+        ("connection_type", "connection", "host"),
+        collect=_queue_depths("request_q"),
+    ),
+    Gauge(
+        "entrance_connection_result_queue_depth",
+        "Results queued from connections' worker threads",
+        ("connection_type", "connection", "host"),
+        collect=_queue_depths("result_q"),
+    ),
+    Gauge("entrance_threads", "Live threads", collect=_threads),
+]
+
+
+def render():
+    """
+    All metrics, in the text exposition format
+    """
+    lines = []
+    for metric in all_metrics:
+        metric.render(lines)
+    lines.append("")
+    return "\n".join(lines)
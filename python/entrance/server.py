@@ -2,49 +2,232 @@
 #
 # Copyright (c) 2023 Ensoft Ltd
 
-import logging
+import asyncio, logging, signal
 import sys
 
 import sanic
 import sanic.response
 
-from . import WebsocketHandler
+from . import WebsocketHandler, live_config, metrics
+from .exceptions import EntranceError
+from .live_config import LiveConfig
+from .static_assets import StaticAssets
+from ._util import logger, tracing
+from ._util.watchdog import LoopWatchdog
 
 
 log = logging.getLogger(__name__)
 
 
-def create_app(config, file_location) -> sanic.Sanic:
+def create_app(
+    config, file_location, config_file=None, logging_config=None, log_queue=None
+) -> sanic.Sanic:
     """
     Create a simple server with the specified configuration.
 
+    If the config file is given, then the features config can be reloaded
+    from it at runtime (on SIGHUP, or a reload_config request), and is
+    re-read on startup (so that a warm hand-off picks up any changes).
+
+    If a logging config is given, then logging is set up from it (see
+    _util.logger.configure), if not already done in this process. Given a
+    log queue too, records are forwarded there rather than handled here.
+
     If an app needs more elaborate setup, then just copy this function
     and modify.
 
     """
 
-    app = sanic.Sanic(name="entrance-app", log_config=None)
+    if logging_config is not None:
+        logger.configure(logging_config, log_queue)
+
+    # Sanic's own logging setup would add console handlers of its own, so
+    # each of its records would be written twice
+    app = sanic.Sanic(name="entrance-app", configure_logging=False)
     app.config.RESPONSE_TIMEOUT = 3600
     app.config.KEEP_ALIVE_TIMEOUT = 75
 
-    # Websocket handling
+    live = live_config.current = LiveConfig(config, config_file)
+    if config_file is not None:
+        try:
+            live.reload()
+        except EntranceError as e:
+            log.error("Using initial feature config: %s", e)
+
+    # Websocket handling. Each session gets the features config current at
+    # the time it starts.
+    sessions = set()
+
     @app.websocket("/ws")
     async def handle_ws(request, ws):
+        if draining:
+            # Send the client off to reconnect to our replacement
+            await ws.close(code=1012, reason="Service restart")
+            return
         log.info("New websocket client")
-        ws_handler = WebsocketHandler(ws, config["features"])
-        await ws_handler.handle_incoming_requests()
+        ws_handler = WebsocketHandler(ws, live.features)
+        sessions.add(ws)
+        try:
+            await ws_handler.handle_incoming_requests()
+        finally:
+            sessions.discard(ws)
+
+    # Reload the features config on SIGHUP, and hand off on SIGUSR2
+    def on_signal(action, what):
+        try:
+            action()
+        except EntranceError as e:
+            log.error("%s failed: %s", what, e)
+
+    @app.listener("after_server_start")
+    async def add_signal_handlers(app):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, on_signal, live.reload, "Reload")
+            loop.add_signal_handler(signal.SIGUSR2, on_signal, handoff, "Hand-off")
+        except (AttributeError, NotImplementedError):
+            pass  # not on Windows
+
+    # Warm hand-off (on SIGUSR2, or a force_restart request with mode
+    # "handoff"): start a fresh worker process, which loads any upgraded code
+    # and reloaded config and shares the listening socket, and then shut this
+    # one down gracefully. Before it stops, it closes its websockets one at a
+    # time over handoff_drain seconds (and turns away any new ones), so that
+    # clients (and the router connections they own) move across gradually
+    # rather than all at once.
+    drain_time = config["start"].get("handoff_drain", 60)
+    handoff_started = False
+    draining = False
+
+    def handoff():
+        nonlocal handoff_started
+        if handoff_started:
+            return
+        try:
+            restart = app.m.restart
+        except AttributeError:
+            raise EntranceError("Worker restarts unsupported by this Sanic")
+        log.info("Starting warm hand-off over %ss", drain_time)
+        handoff_started = True
+        restart(zero_downtime=True)
+
+    live.on_handoff = handoff
+
+    @app.listener("before_server_stop")
+    async def drain(app):
+        nonlocal draining
+        if handoff_started:
+            draining = True
+            await _drain(sessions, drain_time)
+
+    # Trace every request into a local file, if configured. (Individual
+    # requests can also ask for a timing breakdown in their reply, by setting
+    # "trace" to true.)
+    if config["start"].get("trace_file") is not None:
+        tracing.configure(config["start"]["trace_file"])
+
+    # Watch for anything blocking the event loop for longer than
+    # loop_lag_threshold seconds (null to disable)
+    lag_threshold = config["start"].get("loop_lag_threshold", 0.25)
+    if lag_threshold is not None:
+        watchdog = LoopWatchdog(lag_threshold)
+
+        @app.listener("after_server_start")
+        async def start_watchdog(app):
+            watchdog.start()
+
+        @app.listener("before_server_stop")
+        async def stop_watchdog(app):
+            watchdog.stop()
+
+    # Run router connections in a pool of connection_processes worker
+    # processes, rather than all in this one (0 or null to disable)
+    connection_processes = config["start"].get("connection_processes", 0)
+    if connection_processes:
+        from .connection.sharded import ShardPool
+
+        shard_pool = ShardPool(connection_processes)
+
+        @app.listener("after_server_start")
+        async def start_shard_pool(app):
+            await shard_pool.start()
+
+        @app.listener("after_server_stop")
+        async def stop_shard_pool(app):
+            await shard_pool.stop()
+
+    # Limits on the syslog history kept for each router (see
+    # feature.tgt_syslog): the most memory that a client can ask for, and how
+    # long to keep it once nobody is monitoring the router
+    start_cfg = config["start"]
+    if "syslog_history_max_bytes" in start_cfg or "syslog_history_ttl" in start_cfg:
+        from .feature import tgt_syslog
+
+        tgt_syslog.MAX_HISTORY_BYTES = start_cfg.get(
+            "syslog_history_max_bytes", tgt_syslog.MAX_HISTORY_BYTES
+        )
+        tgt_syslog.HISTORY_TTL = start_cfg.get(
+            "syslog_history_ttl", tgt_syslog.HISTORY_TTL
+        )
+
+    # Metrics, for scraping by eg Prometheus. Set metrics_path to null in the
+    # start config to disable.
+    metrics_path = config["start"].get("metrics_path", "/metrics")
+    if metrics_path is not None:
+
+        @app.route(metrics_path)
+        async def get_metrics(request):
+            return sanic.response.text(
+                metrics.render(), content_type="text/plain; version=0.0.4"
+            )
 
     # Static file handling
     #
+    # By default, load and precompress everything in the static directory at
+    # startup, and serve it from memory with cache validators. Setting
+    # static_cache to false in the start config instead serves the files from
+    # disk on each request (eg to pick up changes during development).
+    #
     # Note:
     # The order of 'app.static()' and route declarations (with '@app.route()')
     # matters here. For static to be a fallback it should come after route
     # declarations, e.g. if a route path contains a parameter.
     static_dir = file_location + config["start"]["static_dir"]
-    app.static("/", static_dir)
+    if config["start"].get("static_cache", True):
+        static_assets = StaticAssets(static_dir)
 
-    @app.route("/")
-    async def home_page(request):
-        return await sanic.response.file(static_dir + "/index.html")
+        async def static_file(request, path=""):
+            asset = static_assets.get(path)
+            if asset is None:
+                return sanic.response.text("Not found", status=404)
+            return asset.response(request)
+
+        methods = ["GET", "HEAD"]
+        app.add_route(static_file, "/", methods=methods, name="home_page")
+        app.add_route(static_file, "/<path:path>", methods=methods)
+
+    else:
+        app.static("/", static_dir)
+
+        @app.route("/")
+        async def home_page(request):
+            return await sanic.response.file(static_dir + "/index.html")
 
     return app
+
+
+async def _drain(sessions, drain_time):
+    """
+    Close websockets evenly spread over the drain time, telling clients that
+    the service is restarting (so they should reconnect)
+    """
+    if not sessions:
+        return
+    interval = drain_time / len(sessions)
+    log.info("Draining %d websockets, one every %.2fs", len(sessions), interval)
+    for ws in list(sessions):
+        try:
+            await ws.close(code=1012, reason="Service restart")
+        except Exception as e:
+            log.debug("Failed to close websocket during drain: %s", e)
+        await asyncio.sleep(interval)
@@ -0,0 +1,455 @@
+# Local IOS-XR-like device simulator, for testing and benchmarking
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+"""
+Simulate any number of IOS-XR-like devices on localhost, enough to exercise
+the router features (cli_exec, cli_config, syslog and netconf) without any
+real devices or network. All devices share a single SSH port, and the
+username chosen at login is the device's hostname. Any password or key is
+accepted.
+
+The CLI gives just enough of the right shape: command echo, a timestamp line,
+then the output and a "RP/0/RP0/CPU0:<hostname>#" prompt. Any exec command
+not otherwise recognised (eg "show ...") gets output_bytes of canned output
+after a configurable latency. After "terminal monitor", the session
+generates syslog lines at syslog_rate per second. "run sleep <seconds>"
+takes that long to give the prompt back, unless interrupted with Ctrl-C
+(which otherwise just gives a fresh prompt). The "netconf" subsystem
+(on the same port) answers the base:1.0 operations that the netconf feature
+uses, with netconf_bytes of canned data for get and get-config.
+
+Run "python -m entrance.simulator --help" for the command line options.
+"""
+
+__all__ = ("Simulator",)
+
+
+import argparse, functools, logging, random, socket, threading, time, weakref
+from xml.sax.saxutils import quoteattr
+
+import paramiko
+from lxml import etree
+
+log = logging.getLogger(__name__)
+
+NC_BASE_NS = "urn:ietf:params:xml:ns:netconf:base:1.0"
+NC_EOM = b"]]>]]>"
+NC_CAPABILITIES = (
+    "urn:ietf:params:netconf:base:1.0",
+    "urn:ietf:params:netconf:capability:candidate:1.0",
+    "urn:ietf:params:netconf:capability:validate:1.0",
+)
+
+# Exec commands that just give a prompt back
+SILENT_COMMANDS = ("run stty rows 0", "undebug all all-tty", "terminal monitor")
+
+SYSLOG_TEMPLATES = (
+    "ifmgr[257]: %PKT_INFRA-LINK-3-UPDOWN : Interface GigabitEthernet0/0/0/{n},"
+    " changed state to {state}",
+    "ifmgr[257]: %PKT_INFRA-LINEPROTO-5-UPDOWN : Line protocol on Interface"
+    " GigabitEthernet0/0/0/{n}, changed state to {state}",
+    "config[65843]: %MGBL-CONFIG-6-DB_COMMIT : Configuration committed by user"
+    " 'admin'. Use 'show configuration commit changes 10000000{n:02}' to view"
+    " the changes.",
+    "bgp[1052]: %ROUTING-BGP-5-ADJCHANGE : neighbor 10.0.{n}.1 {state}",
+)
+
+
+class Simulator:
+    """
+    SSH server simulating devices, with a thread per session. Call start() to
+    listen (on a free port if port is 0, stored in self.port once started),
+    and stop() to close everything down.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        output_bytes=2000,
+        syslog_rate=0.0,
+        netconf_bytes=5000,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.output_bytes = output_bytes
+        self.syslog_rate = syslog_rate
+        self.netconf_bytes = netconf_bytes
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.sock = None
+        self.transports = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.session_id = 0
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(name="SimAccept", daemon=True, target=self._accept).start()
+
+    def stop(self):
+        self.sock.close()
+        for transport in list(self.transports):
+            transport.close()
+
+    def delay(self):
+        """
+        Sleep for the simulated time a device takes to do something
+        """
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self.sock.accept()
+            except OSError:
+                # Socket closed by stop()
+                return
+            log.debug("Connection from %s:%d", *address)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("netconf", _NetconfSession)
+            self.transports.add(transport)
+            # Passing an event makes the handshake happen in the transport's
+            # own thread, rather than holding up other connections
+            transport.start_server(threading.Event(), _DeviceServer(self))
+
+
+class _DeviceServer(paramiko.ServerInterface):
+    """
+    Accepts any login, and starts a CLI session for a shell request
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.hostname = "sim"
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_auth_password(self, username, password):
+        self.hostname = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        self.hostname = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        session = _CLISession(self.sim, channel, self.hostname)
+        threading.Thread(name="SimCLI", daemon=True, target=session.run).start()
+        return True
+
+
+class _CLISession:
+    """
+    One simulated CLI session
+    """
+
+    def __init__(self, sim, channel, hostname):
+        self.sim = sim
+        self.channel = channel
+        self.hostname = hostname
+        self.config_mode = False
+        self.syslog_thread = None
+        # Syslogs and command output come from different threads
+        self.send_lock = threading.Lock()
+
+    def prompt(self):
+        return "RP/0/RP0/CPU0:{}{}#".format(
+            self.hostname, "(config)" if self.config_mode else ""
+        )
+
+    def send(self, text):
+        with self.send_lock:
+            self.channel.sendall(text.encode())
+
+    def run(self):
+        buf = ""
+        try:
+            while True:
+                data = self.channel.recv(4096)
+                if not data:
+                    break
+                buf += data.decode(errors="replace")
+                if "\x03" in buf:
+                    # Ctrl-C: abandon the line so far
+                    buf = buf.rpartition("\x03")[2]
+                    self.send("^C\r\n" + self.prompt())
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    line = line.rstrip("\r")
+                    output = self.command(line.strip())
+                    self.send("{}\r\n{}{}".format(line, output, self.prompt()))
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.channel.close()
+
+    def command(self, command):
+        """
+        Return the output for one command (not including the echo or prompt)
+        """
+        if command == "":
+            return ""
+        if self.config_mode:
+            if command in ("end", "exit", "abort"):
+                self.config_mode = False
+                return ""
+            if command in ("commit", "validate commit"):
+                self.sim.delay()
+                return _timestamp() + "\r\n"
+            if not command.startswith("show "):
+                # Config lines (and "clear") are accepted silently
+                return ""
+        elif command == "configure":
+            self.config_mode = True
+            return ""
+        elif command in SILENT_COMMANDS or command.startswith("debug "):
+            if command == "terminal monitor":
+                self.start_syslogs()
+            return ""
+        elif command.startswith("run sleep "):
+            return self.sleep(float(command.split()[2]))
+
+        if command == "show configuration failed":
+            return _timestamp() + "\r\n"
+        if command == "show configuration validation unsupported":
+            return _timestamp() + "\r\n% No such configuration item(s)\r\n"
+        self.sim.delay()
+        return _timestamp() + "\r\n" + _cli_output(self.sim.output_bytes)
+
+    def sleep(self, seconds):
+        """
+        Wait (for "run sleep"), unless interrupted by Ctrl-C. Anything else
+        typed meanwhile is lost.
+        """
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                self.channel.settimeout(deadline - time.monotonic())
+                data = self.channel.recv(4096)
+                if not data:
+                    break
+                if b"\x03" in data:
+                    return "^C\r\n"
+        except socket.timeout:
+            pass
+        finally:
+            self.channel.settimeout(None)
+        return ""
+
+    def start_syslogs(self):
+        if self.sim.syslog_rate > 0 and self.syslog_thread is None:
+            self.syslog_thread = threading.Thread(
+                name="SimSyslog", daemon=True, target=self.generate_syslogs
+            )
+            self.syslog_thread.start()
+
+    def generate_syslogs(self):
+        interval = 1 / self.sim.syslog_rate
+        # Spread sessions' syslogs out, rather than all at the same moment
+        next_time = time.monotonic() + random.uniform(0, interval)
+        count = 0
+        try:
+            while not self.channel.closed:
+                time.sleep(max(next_time - time.monotonic(), 0))
+                next_time += interval
+                message = SYSLOG_TEMPLATES[count % len(SYSLOG_TEMPLATES)].format(
+                    n=count % 32, state="Down" if count % 2 else "Up"
+                )
+                self.send(
+                    "RP/0/RP0/CPU0:{}: {}\r\n".format(_timestamp(False), message)
+                )
+                count += 1
+        except (EOFError, OSError):
+            pass
+
+
+class _NetconfSession(paramiko.SubsystemHandler):
+    """
+    Minimal netconf responder, using base:1.0 end-of-message framing
+    """
+
+    def start_subsystem(self, name, transport, channel):
+        server = self.get_server()
+        sim = server.sim
+        with sim.lock:
+            sim.session_id += 1
+            session_id = sim.session_id
+        hello = (
+            "<hello xmlns={}><capabilities>{}</capabilities>"
+            "<session-id>{}</session-id></hello>".format(
+                quoteattr(NC_BASE_NS),
+                "".join("<capability>{}</capability>".format(c) for c in NC_CAPABILITIES),
+                session_id,
+            )
+        )
+        try:
+            channel.sendall(hello.encode() + NC_EOM)
+            buf = b""
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while NC_EOM in buf:
+                    message, buf = buf.split(NC_EOM, 1)
+                    reply, done = _netconf_reply(sim, message)
+                    if reply is not None:
+                        channel.sendall(reply.encode() + NC_EOM)
+                    if done:
+                        return
+        except (EOFError, OSError):
+            pass
+        finally:
+            channel.close()
+
+
+def _netconf_reply(sim, message):
+    """
+    Return the reply to a netconf message (None for a hello), and whether the
+    session is now over
+    """
+    root = etree.fromstring(message.strip())
+    if etree.QName(root).localname == "hello":
+        return None, False
+    ops = [child for child in root if isinstance(child.tag, str)]
+    op = etree.QName(ops[0]).localname if ops else None
+    done = False
+    if op in ("get", "get-config"):
+        sim.delay()
+        body = "<data>{}</data>".format(_netconf_data(sim.netconf_bytes))
+    elif op in ("edit-config", "commit", "validate"):
+        sim.delay()
+        body = "<ok/>"
+    elif op in ("discard-changes", "lock", "unlock", "close-session"):
+        body = "<ok/>"
+        done = op == "close-session"
+    else:
+        body = (
+            "<rpc-error><error-type>protocol</error-type>"
+            "<error-tag>operation-not-supported</error-tag>"
+            "<error-severity>error</error-severity></rpc-error>"
+        )
+    reply = '<?xml version="1.0"?>\n<rpc-reply message-id={} xmlns={}>{}</rpc-reply>'
+    return (
+        reply.format(quoteattr(root.get("message-id", "")), quoteattr(NC_BASE_NS), body),
+        done,
+    )
+
+
+def _timestamp(weekday=True):
+    """
+    Current time in the IOS-XR format, eg "Mon Oct  2 12:34:56.789 UTC"
+    (without the weekday for syslogs)
+    """
+    now = time.time()
+    fmt = "%a %b %e %H:%M:%S" if weekday else "%b %e %H:%M:%S"
+    return "{}.{:03} UTC".format(
+        time.strftime(fmt, time.gmtime(now)), int(now * 1000) % 1000
+    )
+
+
+@functools.lru_cache()
+def _cli_output(nbytes):
+    """
+    Canned "show interfaces brief"-like output of about nbytes
+    """
+    lines = []
+    size = 0
+    n = 0
+    while size < nbytes:
+        line = "  Gi0/0/0/{:<6}  {:>10}  {:>10}  default  {:>6}  {:>10}\r\n".format(
+            n, "up" if n % 3 else "admin-down", "up", 1514, 1000000
+        )
+        lines.append(line)
+        size += len(line)
+        n += 1
+    return "".join(lines)
+
+
+@functools.lru_cache()
+def _netconf_data(nbytes):
+    """
+    Canned interface configuration of about nbytes
+    """
+    entries = []
+    size = 0
+    n = 0
+    while size < nbytes:
+        entry = (
+            "<interface-configuration><active>act</active>"
+            "<interface-name>GigabitEthernet0/0/0/{0}</interface-name>"
+            "<description>simulated interface {0}</description>"
+            "</interface-configuration>"
+        ).format(n)
+        entries.append(entry)
+        size += len(entry)
+        n += 1
+    return (
+        '<interface-configurations xmlns="http://cisco.com/ns/yang/'
+        'Cisco-IOS-XR-ifmgr-cfg">{}</interface-configurations>'.format(
+            "".join(entries)
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate IOS-XR-like devices over SSH on localhost"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=0, help="0 for any")
+    parser.add_argument(
+        "-l", "--latency", type=float, default=0.0, help="seconds per command"
+    )
+    parser.add_argument("-j", "--jitter", type=float, default=0.0)
+    parser.add_argument("-o", "--output-bytes", type=int, default=2000)
+    parser.add_argument(
+        "-s", "--syslog-rate", type=float, default=0.0, help="per session per second"
+    )
+    parser.add_argument("-n", "--netconf-bytes", type=int, default=5000)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if opts.verbose else logging.WARNING)
+
+    sim = Simulator(
+        host=opts.host,
+        port=opts.port,
+        latency=opts.latency,
+        jitter=opts.jitter,
+        output_bytes=opts.output_bytes,
+        syslog_rate=opts.syslog_rate,
+        netconf_bytes=opts.netconf_bytes,
+    )
+    sim.start()
+    # Tools (eg benchmarks) starting the simulator look for this line
+    print("Listening on {}:{}".format(sim.host, sim.port), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# In-memory, precompressed static file serving
+#
+# Copyright (c) 2023 Ensoft Ltd
+
+import gzip, hashlib, logging, mimetypes, os, re
+
+import sanic.response
+
+# brotli is optional: without it, just serve gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# Filenames with a content hash in them (eg main.1f19ae8e.js) never change, so
+# can be cached forever. Anything else has to be revalidated each time. The
+# hash must have a hex letter in it, so that eg report-20231019.csv doesn't
+# count (an all-digit hash just misses out on the caching).
+_hashed_name = re.compile(r"[.-](?=[0-9]*[a-f])[0-9a-f]{8,}\.")
+_cache_immutable = "public, max-age=31536000, immutable"
+_cache_revalidate = "no-cache"
+
+
+class StaticAsset:
+    """
+    One static file, with any smaller encodings, and the cache headers for
+    each. Each encoding has its own (strong) ETag, as they are different
+    representations.
+    """
+
+    __slots__ = ("content_type", "digest", "cache_control", "encodings")
+
+    def __init__(self, path, data):
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(data).hexdigest()[:32]
+        self.cache_control = (
+            _cache_immutable
+            if _hashed_name.search(os.path.basename(path))
+            else _cache_revalidate
+        )
+
+        # Encodings in order of preference, with the identity last. Only keep
+        # compressed versions that are worth it (so not eg for PNGs)
+        self.encodings = []
+        if brotli is not None:
+            self._add_encoding("br", data, brotli.compress(data))
+        self._add_encoding("gzip", data, gzip.compress(data, 9))
+        self.encodings.append((None, data, self._headers(None)))
+
+    def _add_encoding(self, encoding, data, compressed):
+        if len(compressed) < 0.9 * len(data):
+            self.encodings.append((encoding, compressed, self._headers(encoding)))
+
+    def _headers(self, encoding):
+        """
+        Headers for the given encoding of the file
+        """
+        headers = {
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding is None:
+            headers["ETag"] = '"{}"'.format(self.digest)
+        else:
+            headers["ETag"] = '"{}-{}"'.format(self.digest, encoding)
+            headers["Content-Encoding"] = encoding
+        return headers
+
+    def response(self, request):
+        """
+        Build the response to a request, given its validators and accepted
+        encodings
+        """
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        for encoding, body, headers in self.encodings:
+            if encoding is None or encoding in accepted:
+                break
+
+        # If-None-Match uses weak comparison, so ignore any W/ prefixes
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or headers["ETag"] in (_strip_weak(tag) for tag in if_none_match.split(","))
+        ):
+            return sanic.response.raw(b"", status=304, headers=headers)
+
+        return sanic.response.raw(
+            body, headers=headers, content_type=self.content_type
+        )
+
+
+class StaticAssets:
+    """
+    All the files under a static directory, loaded and compressed once at
+    startup, and then served from memory
+    """
+
+    def __init__(self, directory):
+        self.assets = {}
+        total = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as f:
+                    data = f.read()
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                self.assets[name] = StaticAsset(name, data)
+                total += len(data)
+        log.info(
+            "Loaded %d static files (%d bytes) from %s%s",
+            len(self.assets),
+            total,
+            directory,
+            "" if brotli is not None else " (no brotli)",
+        )
+
+    def get(self, path):
+        """
+        Look up the asset for a URL path, with directories meaning their
+        index.html, or None if there's no such file
+        """
+        path = path.strip("/")
+        asset = self.assets.get(path)
+        if asset is None:
+            asset = self.assets.get((path + "/index.html").lstrip("/"))
+        return asset
+
+
+def _strip_weak(tag):
+    """
+    An entity tag from If-None-Match, without any W/ (weak) prefix
+    """
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _accepted_encodings(header):
+    """
+    Parse an Accept-Encoding header into the set of acceptable encodings
+    """
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
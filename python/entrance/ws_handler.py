@@ -3,19 +3,16 @@
 # Copyright (c) 2018 Ensoft Ltd
 
 from collections import defaultdict
-import asyncio, logging
+import asyncio, functools, logging, time
 import ujson
 from websockets.exceptions import ConnectionClosed
+from . import metrics
 from .connection import ConState
 from .feature import *
-from ._util import events
+from ._util import events, tracing
 
 log = logging.getLogger(__name__)
 
-# Once: normalize the Feature schemas, so that subclasses pick up the supported
-# requests or notifications from their ancestor classes
-Feature.normalize_schema()
-
 # Turn multiple args into a single flat key for dict lookups
 def _mktuple(*args):
     return "||".join(args)
@@ -28,24 +25,34 @@ class WebsocketHandler:
     objects is instantiated for each client session.
     """
 
+    # There can be many thousands of these, mostly idle, so keep them small
+    __slots__ = (
+        "ws",
+        "request_map_default",
+        "request_map_optional",
+        "features",
+        "target_features",
+        "target_group",
+        "tasks",
+    )
+
     def __init__(self, ws, feature_config):
         self.ws = ws
-        self.conn_factory = None
         self.request_map_default = {}
         self.request_map_optional = {}
         self.features = []
         self.target_features = defaultdict(list)
         self.target_group = {}
-        self.con_state_listeners = []
+        self.tasks = {}
 
         # Start out with just the configured features
-        for feature_cls in ConfiguredFeature.all():
-            name = feature_cls.name
-            if name in feature_config:
-                log.debug("Adding configured feature %s", name)
-                self.add_feature(feature_cls(self, feature_config[name]))
+        for name, config in feature_config.items():
+            feature_cls = feature_by_name.get(name)
+            if feature_cls is None or not issubclass(feature_cls, ConfiguredFeature):
+                log.warning("Skipping unknown configured feature %s", name)
             else:
-                log.debug("Skipping unconfigured feature %s", name)
+                log.debug("Adding configured feature %s", name)
+                self.add_feature(feature_cls(self, config))
 
     async def handle_incoming_requests(self):
         """
@@ -95,15 +102,26 @@ class WebsocketHandler:
         req_type = request["req_type"]
         channel = request["channel"]
         target = request.get("target", "")
-        if req_type != "ping":
+        if req_type != "ping" and log.isEnabledFor(logging.DEBUG):
             log.debug("WS RECV: %s", abbreviate(request))
 
-        # Dispatch the request
+        # Start a trace if wanted, which follows the request (including into
+        # the task for an optional feature)
+        token = tracing.current.set(tracing.start(request))
+        try:
+            await self._dispatch_req(request, req_type, channel, target)
+        finally:
+            tracing.current.reset(token)
+
+    async def _dispatch_req(self, request, req_type, channel, target):
+        """
+        Pass a request on to the appropriate Feature
+        """
         try:
             # First try default features - these are keyed just off req_type,
             # and are executed synchronously (since they are supposed to be
             # quick, and can include meta-operations like starting new features)
-            feature = self.request_map_default[req_type]
+            feature = self.features[self.request_map_default[req_type]]
             await feature.handle(request)
         except KeyError:
             # Fall back to optional features - these are keyed off the
@@ -113,7 +131,7 @@ class WebsocketHandler:
             try:
                 key = _mktuple(req_type, channel, target)
                 feature = self.request_map_optional[key]
-                events.create_checked_task(feature.handle(request))
+                task = events.create_checked_task(feature.handle(request))
             except KeyError:
                 log.warning("Un-handleable request {}".format(request))
                 log.debug(
@@ -125,15 +143,42 @@ class WebsocketHandler:
                     "Don't know how to handle request {}".format(request)
                 )
                 return
+            if "id" in request:
+                self._track_task(request["id"], task)
+
+    def _track_task(self, req_id, task):
+        """
+        Remember the task handling a request with an id, until it's done, so
+        that it can be cancelled
+        """
+        self.tasks[req_id] = task
+
+        def done(task):
+            if self.tasks.get(req_id) is task:
+                del self.tasks[req_id]
+
+        task.add_done_callback(done)
+
+    def cancel_request(self, req_id):
+        """
+        Cancel the task handling a request, returning whether there was one
+        """
+        task = self.tasks.get(req_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
 
     async def notify(self, **nfn):
         """
         Send a specific outbound notification
         """
-        if nfn["nfn_type"] != "pong":
-            log.debug("WS SEND: {}".format(abbreviate(nfn)))
+        if nfn["nfn_type"] != "pong" and log.isEnabledFor(logging.DEBUG):
+            log.debug("WS SEND: %s", abbreviate(nfn))
+        start = time.perf_counter()
         json = ujson.dumps(nfn)
         await self.ws.send(json)
+        metrics.notify_latency.observe((nfn["nfn_type"],), time.perf_counter() - start)
 
     async def notify_error(self, error, **nfn):
         """
@@ -148,9 +193,14 @@ class WebsocketHandler:
         self.features.append(feature)
         if isinstance(feature, ConfiguredFeature):
             # Configured feature: just add the handled request_types to the
-            # default request map
-            for req_type in feature.requests.keys():
-                self.request_map_default[req_type] = feature
+            # default request map (which maps to positions in self.features,
+            # so can be shared by all sessions with the same features)
+            self.request_map_default = _default_request_map(
+                tuple(
+                    type(f) if isinstance(f, ConfiguredFeature) else None
+                    for f in self.features
+                )
+            )
         else:
             # Dynamic feature: add the <request_type, channel, target> triple
             # to the optional request map
@@ -220,6 +270,21 @@ class WebsocketHandler:
         for feature in self.features:
             feature.close()
 
+
+@functools.lru_cache()
+def _default_request_map(feature_classes):
+    """
+    Map of req_type -> index into a list of features with the given classes
+    (None for dynamic features), for all the configured features' requests
+    """
+    return {
+        req_type: index
+        for index, feature_cls in enumerate(feature_classes)
+        if feature_cls is not None
+        for req_type in feature_cls.requests
+    }
+
+
 MAX_LENGTH = 200
 
 
@@ -14,7 +14,7 @@ from setuptools import find_packages, setup
 
 # Router features require heavy dependencies, so include only when actually required
 # via depending on 'entrance[with-router-features' rather than just 'entrance'.
-router_feature_deps = ["janus", "ncclient", "paramiko"]
+router_feature_deps = ["ncclient", "paramiko"]
 
 # Acutally, an icky second way of including the optional dependencies would just be
 # to rewrite this from '[]' to 'router_feature_deps'. I'm looking at you, nix...
@@ -53,5 +53,8 @@ setup(
         "Programming Language :: Python :: 3.8",
     ],
     install_requires=["pyyaml", sanic, ujson] + extra_deps,
-    extras_require={"with-router-features": router_feature_deps},
+    extras_require={
+        "with-router-features": router_feature_deps,
+        "with-brotli": ["brotli"],
+    },
 )